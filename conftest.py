@@ -0,0 +1 @@
+# Lets the tests import the functions package from the repository root
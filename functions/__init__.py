@@ -1,3 +1,5 @@
 from .utils_get import *
 from .utils_plot import *
-from .utils_shift import *
\ No newline at end of file
+from .utils_shift import *
+from .utils_dataset import *
+from .utils_quality import *
@@ -0,0 +1,186 @@
+import numpy as np
+import pandas as pd
+import glob
+import os
+from .utils_get import META_COLUMNS, file_signature, read_timeseries_csv, get_grid_demand, get_grid_renew_wide
+
+# Every source is stored on this grid, as UTC nanoseconds
+DATASET_STEP = pd.Timedelta(minutes=15)
+
+# Lists the sources build_dataset() stored, one name per line
+MANIFEST_FILE = 'manifest.txt'
+
+# Bumped when align_source() changes what a stored source holds, so sources
+# stored by an older version are rebuilt (2: META_COLUMNS left out)
+DATASET_VERSION = 2
+
+def csv_source(pattern):
+    # Source made of CSVs whose first column is the timestamp (ls_ctr, climate,
+    # moer_15, sMap exports), joined on datetime when the pattern matches several
+    def loader(pattern):
+        dfs = [read_timeseries_csv(f).set_index('datetime') for f in sorted(glob.glob(pattern))]
+        return pd.concat(dfs, axis=1)
+    return {'files': pattern, 'loader': loader, 'hold': 0}
+
+def default_sources(root='../readfiles'):
+    # The inputs of the analysis. CAISO values are hourly, so each one is held
+    # for the three following 15-minute steps. Sources without files (e.g. the
+    # sMap sw export before it is downloaded) are skipped by build_dataset()
+    sources = {'moer': csv_source(os.path.join(root, 'moer', 'moer_15.csv')),
+               'climate': csv_source(os.path.join(root, 'climate', 'climate.csv')),
+               'sw': csv_source(os.path.join(root, 'sw', 'sw.csv'))}
+    for filepath in sorted(glob.glob(os.path.join(root, 'ls_ctr', '*.csv'))):
+        name = os.path.splitext(os.path.basename(filepath))[0]
+        sources[name] = csv_source(filepath)
+    sources['demand'] = {'files': os.path.join(root, 'grid', 'demand', '*.csv'),
+                         'loader': get_grid_demand, 'hold': 3}
+    sources['renew'] = {'files': os.path.join(root, 'grid', 'renewables', '*.csv'),
+                        'loader': get_grid_renew_wide, 'hold': 3}
+    return sources
+
+def align_source(df, hold=0):
+    # Loader output (tz-aware 'datetime' column or index) -> numeric columns
+    # averaged onto the UTC 15-minute grid. Site metadata (META_COLUMNS, the
+    # constant lat / long of climate.csv) is not a signal and is left out.
+    # hold forward-fills each value over that many following empty steps
+    if 'datetime' in df.columns:
+        df = df.set_index('datetime')
+    df = df.drop(columns=[col for col in META_COLUMNS if col in df.columns])
+    df = df.select_dtypes('number')
+    df.index = pd.DatetimeIndex(df.index).tz_convert('UTC')
+    df = df.resample(DATASET_STEP).mean()
+    if hold:
+        df = df.ffill(limit=hold)
+    return df
+
+def _read_manifest(store_dir):
+    # Names of the sources build_dataset() stored in store_dir, in order
+    manifest_file = os.path.join(store_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_file):
+        return []
+    with open(manifest_file) as f:
+        return [line.strip() for line in f if line.strip()]
+
+def _write_manifest(store_dir, names):
+    manifest_file = os.path.join(store_dir, MANIFEST_FILE)
+    with open(manifest_file + '.tmp', 'w') as f:
+        f.writelines(name + '\n' for name in names)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+def build_dataset(sources, store_dir, force=False, prune=False):
+    # Align every source onto the 15-minute grid and store it as one columnar
+    # .npz per source in store_dir. A source is rebuilt only when the files it
+    # matches changed (path, size, mtime). Returns the names rebuilt.
+    # The stored sources are listed in the store's manifest, and only those
+    # are read back or removed: other .npz files in store_dir are left alone.
+    # prune=True removes the stored sources that are not in sources, so by
+    # default building a subset keeps the rest of the store
+    os.makedirs(store_dir, exist_ok=True)
+    stored_names = _read_manifest(store_dir)
+    rebuilt = []
+    for name, spec in sources.items():
+        signature = file_signature(sorted(glob.glob(spec['files'])))
+        store_file = os.path.join(store_dir, name + '.npz')
+        if len(signature) == 0:
+            continue
+        if not force and name in stored_names and os.path.exists(store_file):
+            with np.load(store_file, allow_pickle=False) as stored:
+                if ('__version__' in stored.files and int(stored['__version__']) == DATASET_VERSION
+                        and np.array_equal(stored['__source__'], signature)):
+                    continue
+
+        df = align_source(spec['loader'](spec['files']), spec.get('hold', 0))
+        arrays = {'__source__': signature,
+                  '__version__': np.array(DATASET_VERSION),
+                  '__columns__': np.array(list(df.columns), dtype=str),
+                  '__start__': np.array(df.index[0].value if len(df) else 0, dtype=np.int64),
+                  '__length__': np.array(len(df))}
+        for i, col in enumerate(df.columns):
+            arrays['c{}'.format(i)] = df[col].to_numpy(dtype=float)
+
+        tmp_file = store_file[:-4] + '.tmp.npz'
+        np.savez(tmp_file, **arrays)
+        os.replace(tmp_file, store_file)
+        rebuilt.append(name)
+        if name not in stored_names:
+            stored_names.append(name)
+            _write_manifest(store_dir, stored_names)
+
+    if prune:
+        dropped = [name for name in stored_names if name not in sources]
+        stored_names = [name for name in stored_names if name in sources]
+        _write_manifest(store_dir, stored_names)
+        for name in dropped:
+            store_file = os.path.join(store_dir, name + '.npz')
+            if os.path.exists(store_file):
+                os.remove(store_file)
+
+    return rebuilt
+
+def dataset_columns(store_dir):
+    # {column: source} over the sources in the store's manifest
+    columns = {}
+    for name in sorted(_read_manifest(store_dir)):
+        with np.load(os.path.join(store_dir, name + '.npz'), allow_pickle=False) as stored:
+            for col in stored['__columns__'].tolist():
+                if col in columns:
+                    raise ValueError("column {} is in both {} and {}".format(col, columns[col], name))
+                columns[col] = name
+    return columns
+
+def _grid_ns(time, tz):
+    # Timestamp (naive = wall clock in tz) -> UTC ns, rounded up onto the grid
+    time = pd.Timestamp(time)
+    if time.tz is None:
+        time = time.tz_localize(tz)
+    step = DATASET_STEP.value
+    return -(-time.value // step) * step
+
+def load_dataset(store_dir, columns=None, start=None, end=None, tz='America/Los_Angeles'):
+    # Wide 15-minute frame from the store: 'datetime' (tz-aware, in tz) and
+    # the requested columns (all by default) for start <= datetime < end.
+    # Only the arrays of the requested columns are read, and only the rows in
+    # the time range are kept
+    source_of = dataset_columns(store_dir)
+    if columns is None:
+        columns = list(source_of)
+    missing = [col for col in columns if col not in source_of]
+    if missing:
+        raise KeyError("not in the dataset: {}".format(missing))
+
+    step = DATASET_STEP.value
+    by_source = {}
+    for col in columns:
+        by_source.setdefault(source_of[col], []).append(col)
+
+    # Extent of the requested sources, clipped by the time range
+    extents = {}
+    for name in by_source:
+        with np.load(os.path.join(store_dir, name + '.npz'), allow_pickle=False) as stored:
+            first = int(stored['__start__'])
+            extents[name] = (first, first + int(stored['__length__']) * step)
+    lo = min((e[0] for e in extents.values()), default=0)
+    hi = max((e[1] for e in extents.values()), default=0)
+    if start is not None:
+        lo = max(lo, _grid_ns(start, tz))
+    if end is not None:
+        hi = min(hi, _grid_ns(end, tz))
+    n = max(0, (hi - lo) // step)
+
+    values = {col: np.full(n, np.nan) for col in columns}
+    for name, cols in by_source.items():
+        first, last = extents[name]
+        a, b = max(lo, first), min(hi, last)
+        if a >= b:
+            continue
+        rows = slice((a - first) // step, (b - first) // step)
+        out = slice((a - lo) // step, (b - lo) // step)
+        with np.load(os.path.join(store_dir, name + '.npz'), allow_pickle=False) as stored:
+            index = {col: i for i, col in enumerate(stored['__columns__'].tolist())}
+            for col in cols:
+                values[col][out] = stored['c{}'.format(index[col])][rows]
+
+    datetime = pd.to_datetime(lo + np.arange(n) * step, unit='ns', utc=True).tz_convert(tz)
+    df = pd.DataFrame(values, columns=columns)
+    df.insert(0, 'datetime', datetime)
+    return df
@@ -2,185 +2,339 @@
 import numpy as np
 import pandas as pd
 import glob
+import os
+import re
+import hashlib
+import weakref
+import pytz
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+# Keywords behind each point category
+POINT_CATEGORIES = {
+    "pump": ["CHP", "SCHWP"],
+    "cw_pump": ["CWP"],
+    "current": ["CURRENT", "CT"],
+    "power": ["POWER", "PWR"],
+    "demand": ["DEMAND"],
+}
+
+# Columns describing the site rather than measuring it (climate.csv)
+META_COLUMNS = ('lat', 'long', 'time_zone')
+
+class PointIndex:
+    # Column index of a sMap export, built once per DataFrame. The column list
+    # of every category is resolved up front, so selector calls are
+    # dictionary lookups. Point names such as SDH.SW.MSA.CH-2.PWR REAL 3 P
+    # are parsed into site / system / device / quantity fields on first use
+    # of points
+
+    def __init__(self, columns):
+        self.columns = columns
+        self._points = None
+        self._matches = {}
+        for category, words in POINT_CATEGORIES.items():
+            self._matches[category] = self.match(words)
+
+    @property
+    def points(self):
+        # One row per column: site.system.<device...>.quantity split on the
+        # first two and the last dot. Names with fewer than two dots (the
+        # ls_ctr exports, e.g. AH2B_SF_CFM) are only a quantity
+        if self._points is None:
+            rows = []
+            for col in self.columns:
+                parts = str(col).split('.', 2)
+                if len(parts) < 3:
+                    rows.append((None, None, None, str(col)))
+                else:
+                    device, _, quantity = parts[2].rpartition('.')
+                    rows.append((parts[0], parts[1], device or None, quantity))
+            self._points = pd.DataFrame(rows, index=self.columns,
+                                        columns=['site', 'system', 'device', 'quantity'])
+        return self._points
+
+    def match(self, words):
+        # Columns containing any of the words, cached per word list
+        key = tuple(words)
+        if key not in self._matches:
+            self._matches[key] = [col for col in self.columns if any(word in str(col) for word in words)]
+        return self._matches[key]
+
+    def category(self, name):
+        return self._matches[name]
+
+# PointIndex per live DataFrame, keyed by id and dropped with the frame
+_point_indexes = {}
+
+def point_index(df):
+    cached = _point_indexes.get(id(df))
+    if cached is not None and cached[0]() is df and cached[1].columns is df.columns:
+        return cached[1]
+
+    key = id(df)
+    index = PointIndex(df.columns)
+    _point_indexes[key] = (weakref.ref(df, lambda _, key=key: _point_indexes.pop(key, None)), index)
+    return index
+
+def select_points(df, cols):
+    # 'datetime' plus the given columns. With pandas copy-on-write enabled
+    # (pd.options.mode.copy_on_write, default from pandas 3) the data is only
+    # copied once the selection is written to; otherwise this is a copy.
+    # Writes to the selection never reach df
+    return df[['datetime'] + cols]
 
 def get_pump(df, loop = "CHW"):
 
     if loop == "CHW":
     # Get chilled water loop
-        keywords = {"pump":["CHP", "SCHWP"]}
-
-        columns_with_keywords = {}
-        # Identify columns containing the keywords
-        for keyword in keywords:
-            # Initialize a list to hold column names for this keyword
-            columns_with_keywords[keyword] = []
-            
-            # Inner loop iterates over each column name in the DataFrame
-            for col in df.columns:
-                # Check if the keyword is in the column name
-
-                for word in keywords[keyword]:
-                    if word in col:
-                        # If yes, append the column name to the list for this keyword
-                        columns_with_keywords[keyword].append(col)
-
-
-        # Create sub DataFrames based on identified columns
-        sub_dataframes = {}
-        for keyword, cols in columns_with_keywords.items():
-            # Include the first column ('ID') and the columns with the keyword
-            selected_cols = ['datetime'] + cols
-            sub_dataframes[keyword] = df[selected_cols]
-
-        df_pump = sub_dataframes['pump'] 
-    
+        df_pump = select_points(df, point_index(df).category("pump"))
+
     elif loop == "CW":
-    # Get chilled water loop
-        keywords = {"pump":["CWP"]}
-
-        columns_with_keywords = {}
-        # Identify columns containing the keywords
-        for keyword in keywords:
-            # Initialize a list to hold column names for this keyword
-            columns_with_keywords[keyword] = []
-            
-            # Inner loop iterates over each column name in the DataFrame
-            for col in df.columns:
-                # Check if the keyword is in the column name
-
-                for word in keywords[keyword]:
-                    if word in col:
-                        # If yes, append the column name to the list for this keyword
-                        columns_with_keywords[keyword].append(col)
-
-
-        # Create sub DataFrames based on identified columns
-        sub_dataframes = {}
-        for keyword, cols in columns_with_keywords.items():
-            # Include the first column ('ID') and the columns with the keyword
-            selected_cols = ['datetime'] + cols
-            sub_dataframes[keyword] = df[selected_cols]
-
-        df_pump = sub_dataframes['pump']
-    
+    # Get condenser water loop
+        df_pump = select_points(df, point_index(df).category("cw_pump"))
+
     return df_pump
 
 
 def get_CT(df):
-    keywords = {"current":["CURRENT", "CT"]}
-
-    columns_with_keywords = {}
-    # Identify columns containing the keywords
-    for keyword in keywords:
-        # Initialize a list to hold column names for this keyword
-        columns_with_keywords[keyword] = []
-        
-        # Inner loop iterates over each column name in the DataFrame
-        for col in df.columns:
-            # Check if the keyword is in the column name
-
-            for word in keywords[keyword]:
-                if word in col:
-                    # If yes, append the column name to the list for this keyword
-                    columns_with_keywords[keyword].append(col)
-
-
-    # Create sub DataFrames based on identified columns
-    sub_dataframes = {}
-    for keyword, cols in columns_with_keywords.items():
-        # Include the first column ('ID') and the columns with the keyword
-        selected_cols = ['datetime'] + cols
-        sub_dataframes[keyword] = df[selected_cols]
-
-    df_current = sub_dataframes['current'] 
+    df_current = select_points(df, point_index(df).category("current"))
     return df_current
 
 def get_power(df, unit = "W"):
-    keywords = {"power":['POWER', 'PWR']}
-
-    columns_with_keywords = {}
-    # Identify columns containing the keywords
-    for keyword in keywords:
-        # Initialize a list to hold column names for this keyword
-        columns_with_keywords[keyword] = []
-        
-        # Inner loop iterates over each column name in the DataFrame
-        for col in df.columns:
-            # Check if the keyword is in the column name
-
-            for word in keywords[keyword]:
-                if word in col:
-                    # If yes, append the column name to the list for this keyword
-                    columns_with_keywords[keyword].append(col)
-
-
-    # Create sub DataFrames based on identified columns
-    sub_dataframes = {}
-    for keyword, cols in columns_with_keywords.items():
-        # Include the first column ('ID') and the columns with the keyword
-        selected_cols = ['datetime'] + cols
-        sub_dataframes[keyword] = df[selected_cols]
-
-    df_pwr = sub_dataframes['power']
+    cols = point_index(df).category("power")
+    df_pwr = select_points(df, cols)
 
     if unit == "W":
-        df_pwr.iloc[:, 1:] = df_pwr.iloc[:, 1:] / 1000
-    
+        # build the scaled frame rather than write into the selection
+        df_pwr = pd.concat([df_pwr[['datetime']], df_pwr[cols] / 1000], axis=1)
+
     return df_pwr
 
 def get_demand(df):
     # split into peak demand and power dataframe
-    # Define the keywords
-    keywords = ['DEMAND']
-
-    # Identify columns containing the keywords
-    columns_with_keywords = {keyword: [col for col in df.columns if keyword in col] for keyword in keywords}
-
-
-    # Create sub DataFrames based on identified columns
-    sub_dataframes = {}
-    for keyword, cols in columns_with_keywords.items():
-        # Include the first column ('ID') and the columns with the keyword
-        selected_cols = ['datetime'] + cols
-        sub_dataframes[keyword] = df[selected_cols]
-
-    df_DEMAND = sub_dataframes['DEMAND']
+    df_DEMAND = select_points(df, point_index(df).category("demand"))
     return df_DEMAND
 
 def get_substation(df, keyword = 'MSA.'):
+    df_substation = select_points(df, point_index(df).match([keyword]))
+    return df_substation
 
-    # Identify columns containing the keywords
-    columns_with_keywords = {keyword: [col for col in df.columns if keyword in col]}
+def compact_frame(df, rtol=1e-6, meta=META_COLUMNS):
+    # Compact dtypes in place of a copy of df: float64 columns that survive a
+    # float32 round trip within rtol become float32, meta columns holding a
+    # single value move to df.attrs['constants'] and repeated strings become
+    # categoricals. Measurements that happen to be constant (a sensor stuck
+    # over the period) are kept. Memory before/after (bytes) is kept in
+    # df.attrs['memory']
+    before = df.memory_usage(deep=True).sum()
+    df = df.copy()
+    constants = dict(df.attrs.get('constants', {}))
+
+    for col in list(df.columns):
+        values = df[col]
+        if pd.api.types.is_datetime64_any_dtype(values) or len(df) < 2:
+            continue
+        if col in meta and values.nunique(dropna=False) == 1:
+            value = values.iloc[0]
+            constants[col] = value.item() if isinstance(value, np.generic) else value
+            df.drop(columns=col, inplace=True)
+        elif values.dtype == np.float64:
+            narrow = values.to_numpy().astype(np.float32)
+            if np.allclose(narrow, values.to_numpy(), rtol=rtol, atol=0, equal_nan=True):
+                df[col] = narrow
+        elif values.dtype == object or pd.api.types.is_string_dtype(values):
+            if values.nunique() < len(values) // 2:
+                df[col] = values.astype('category')
+
+    df.attrs['constants'] = constants
+    df.attrs['memory'] = {'before': int(before), 'after': int(df.memory_usage(deep=True).sum())}
+    return df
 
-    # Create sub DataFrames based on identified columns
-    sub_dataframes = {}
-    for keyword, cols in columns_with_keywords.items():
-        # Include the first column ('ID') and the columns with the keyword
-        selected_cols = ['datetime'] + cols
-        sub_dataframes[keyword] = df[selected_cols]
+def memory_report(df):
+    # One line summary of df.attrs['memory'] set by compact_frame()
+    memory = df.attrs['memory']
+    return '{:.1f} MB -> {:.1f} MB ({:.1f}x less)'.format(
+        memory['before'] / 1e6, memory['after'] / 1e6, memory['before'] / max(memory['after'], 1))
+
+def _to_columns(df):
+    # Frame -> dict of plain arrays plus the dtype of every column, so
+    # _from_columns() gives back the same frame. tz-aware datetimes are stored
+    # as UTC, categoricals as codes and categories, and strings with a mask of
+    # the missing values
+    columns = {'__dtypes__': np.array([str(dtype) for dtype in df.dtypes])}
+    if not df.index.equals(pd.RangeIndex(len(df))):
+        columns['__index__'] = df.index.to_numpy()
+    for col in df.columns:
+        values = df[col]
+        if isinstance(values.dtype, pd.DatetimeTZDtype):
+            columns[col] = values.dt.tz_convert('UTC').dt.tz_localize(None).to_numpy()
+        elif isinstance(values.dtype, pd.CategoricalDtype):
+            columns[col] = values.cat.codes.to_numpy()
+            columns['__categories__' + col] = values.cat.categories.to_numpy().astype(str)
+        elif pd.api.types.is_numeric_dtype(values) or pd.api.types.is_datetime64_dtype(values):
+            columns[col] = values.to_numpy()
+        else:
+            missing = values.isna().to_numpy()
+            columns[col] = values.to_numpy(dtype=object, na_value='').astype(str)
+            if missing.any():
+                columns['__missing__' + col] = missing
+    return columns
+
+def _from_columns(columns, names):
+    keys = set(columns.keys())
+    data = {}
+    for name, dtype in zip(names, columns['__dtypes__'].tolist()):
+        values = columns[name]
+        dtype = pd.api.types.pandas_dtype(dtype)
+        if isinstance(dtype, pd.DatetimeTZDtype):
+            data[name] = pd.Series(values).dt.tz_localize('UTC').astype(dtype).array
+        elif isinstance(dtype, pd.CategoricalDtype):
+            data[name] = pd.Categorical.from_codes(values, columns['__categories__' + name])
+        elif values.dtype.kind == 'U':
+            values = values.astype(object)
+            if '__missing__' + name in keys:
+                values[columns['__missing__' + name]] = np.nan
+            data[name] = pd.array(values, dtype=dtype) if dtype != object else values
+        else:
+            data[name] = values
+    index = columns['__index__'] if '__index__' in keys else None
+    return pd.DataFrame(data, index=index, columns=names)
+
+def file_signature(filepaths):
+    # 'path|size|mtime' of every file, compared to tell whether cached
+    # results derived from the files are still current
+    signature = []
+    for f in filepaths:
+        stat = os.stat(f)
+        signature.append('{}|{}|{}'.format(os.path.abspath(f), stat.st_size, stat.st_mtime_ns))
+    return np.array(signature)
+
+def read_cached(filepath, tag, reader, cache_dir):
+    # Parse one source file with reader and keep the result as a columnar .npz
+    # in cache_dir. The entry is reused while the file's path, size and mtime
+    # are unchanged, so new or edited monthly files are the only ones re-parsed
+    source = np.r_[[tag], file_signature([filepath])]
+    key = hashlib.sha1('{}|{}'.format(os.path.abspath(filepath), tag).encode()).hexdigest()
+    cache_file = os.path.join(cache_dir, key + '.npz')
+
+    if os.path.exists(cache_file):
+        with np.load(cache_file, allow_pickle=False) as cached:
+            # entries written before dtypes were recorded are rebuilt
+            if '__dtypes__' in cached.files and np.array_equal(cached['__source__'], source):
+                return _from_columns(cached, cached['__columns__'].tolist())
+
+    df = reader(filepath)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = cache_file[:-4] + '.tmp.npz'
+    np.savez(tmp_file, __source__=source, __columns__=np.array(list(df.columns)), **_to_columns(df))
+    os.replace(tmp_file, cache_file)
 
-    df_substation = sub_dataframes[keyword]
-    return df_substation
+    return df
+
+# CAISO OASIS timestamps, e.g. 2023-01-01T17:00:00-00:00
+GRID_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S%z'
+
+def read_files(filepaths, reader, workers=None):
+    # Parse files concurrently, results keep the order of filepaths
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(reader, filepaths))
+
+# Timestamp styles found in the readfiles inputs, checked in order
+TIME_FORMATS = [
+    (re.compile(r'^\d{1,2}/\d{1,2}/\d{2} \d{1,2}:\d{2}$'), '%m/%d/%y %H:%M'),                  # ls_ctr, 1/20/23 15:45
+    (re.compile(r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}$'), '%Y-%m-%d %H:%M:%S'),             # sat, climate
+    (re.compile(r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}[+-]\d{2}:\d{2}$'), '%Y-%m-%d %H:%M:%S%z'),  # moer_15
+    (re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}[+-]\d{2}:\d{2}$'), GRID_TIME_FORMAT),
+]
+
+def detect_time_format(values):
+    # Format of the first non-empty timestamp, None when no pattern matches
+    values = pd.Series(values).dropna()
+    if len(values) == 0:
+        return None
+    first = str(values.iloc[0]).strip()
+    for pattern, fmt in TIME_FORMATS:
+        if pattern.match(first):
+            return fmt
+    return None
+
+# format='ISO8601' exists from pandas 2.0; older versions infer the format
+ISO8601_FORMAT = {'format': 'ISO8601'} if int(pd.__version__.split('.')[0]) >= 2 else {}
+
+def parse_times(values, tz='America/Los_Angeles'):
+    # Timestamps -> tz-aware datetimes in tz. Strings are parsed with the
+    # format detected from the first value; naive times are taken as wall
+    # clock in tz, times with an offset are converted. Values that are
+    # already datetimes are only localized/converted
+    values = pd.Series(values)
+    if not pd.api.types.is_datetime64_any_dtype(values):
+        fmt = detect_time_format(values)
+        if fmt is None:
+            values = pd.to_datetime(values, **ISO8601_FORMAT)
+        else:
+            values = pd.to_datetime(values, format=fmt, utc='%z' in fmt)
+
+    if values.dt.tz is not None:
+        return values.dt.tz_convert(tz)
+
+    # Fall-back hours appear twice in series written in local time (climate)
+    # and once in series resampled in local time (ls_ctr), where they are
+    # read as daylight time. Spring-forward times that do not exist are NaT
+    # (pandas < 3 raises pytz's AmbiguousTimeError, not a ValueError)
+    try:
+        return values.dt.tz_localize(tz, ambiguous='infer', nonexistent='NaT')
+    except (ValueError, pytz.exceptions.AmbiguousTimeError):
+        return values.dt.tz_localize(tz, ambiguous=True, nonexistent='NaT')
+
+def read_timeseries_csv(filepath, tz='America/Los_Angeles'):
+    # One CSV whose first column is the timestamp -> frame with a tz-aware
+    # 'datetime' first column, rows at non-existent local times dropped
+    df = pd.read_csv(filepath)
+    time_col = df.columns[0]
+    times = parse_times(df[time_col].values, tz)
+    df = df.drop(columns=time_col)
+    df.insert(0, 'datetime', times.array)
+    return df[df['datetime'].notna()].reset_index(drop=True)
+
+def read_timeseries(filepath, tz='America/Los_Angeles', cache_dir=None, compact=False):
+    # read_timeseries_csv(). With a cache_dir the parsed frame is kept there
+    # (see read_cached), so later reads of an unchanged file skip string
+    # parsing; the default None always parses. compact=True applies
+    # compact_frame()
+    if cache_dir is None:
+        df = read_timeseries_csv(filepath, tz)
+    else:
+        reader = partial(read_timeseries_csv, tz=tz)
+        df = read_cached(filepath, 'timeseries|{}'.format(tz), reader, cache_dir)
+    return compact_frame(df) if compact else df
 
 # Define the function to process a single CSV file
 def read_grid_demand(filepath):
 
-    df = pd.read_csv(filepath)
+    # Only read the columns we keep
+    df = pd.read_csv(filepath,
+                     usecols=['INTERVALSTARTTIME_GMT', 'TAC_AREA_NAME', 'MW'],
+                     dtype={'INTERVALSTARTTIME_GMT': str, 'TAC_AREA_NAME': 'category', 'MW': 'float64'})
     df = df[df['TAC_AREA_NAME'] == 'CA ISO-TAC']
     df = df[['INTERVALSTARTTIME_GMT', 'MW']]
-    df['datetime'] = pd.to_datetime(df['INTERVALSTARTTIME_GMT'])
+    df['datetime'] = pd.to_datetime(df['INTERVALSTARTTIME_GMT'], format=GRID_TIME_FORMAT, utc=True)
     df['datetime'] = df['datetime'].dt.tz_convert('America/Los_Angeles')
     df.drop(columns='INTERVALSTARTTIME_GMT', inplace=True)
     df.sort_values(by='datetime', inplace=True)
     return df
 
-def get_grid_demand(filepaths):
+def get_grid_demand(filepaths, cache_dir=None, workers=None, compact=False):
     # Get all CSV file paths from the folder
 
     filepaths = glob.glob(filepaths)
 
     # Process each CSV file and collect the DataFrames
-    dfs = [read_grid_demand(filepath) for filepath in filepaths]
+    if cache_dir is None:
+        dfs = read_files(filepaths, read_grid_demand, workers)
+    else:
+        reader = partial(read_cached, tag='demand', reader=read_grid_demand, cache_dir=cache_dir)
+        dfs = read_files(filepaths, reader, workers)
 
     # Combine all DataFrames vertically
     combined_df = pd.concat(dfs, ignore_index=True)
@@ -196,27 +350,37 @@ def get_grid_demand(filepaths):
     combined_df.reset_index(inplace=True)
     combined_df.columns = ['datetime', 'demand']
 
+    if compact:
+        combined_df = compact_frame(combined_df)
+
     return combined_df
 
 # Define the function to process a single CSV file
 def read_grid_renew(filepath, type):
 
-    df = pd.read_csv(filepath)
+    # Only read the columns we keep
+    df = pd.read_csv(filepath,
+                     usecols=['INTERVALSTARTTIME_GMT', 'RENEWABLE_TYPE', 'TRADING_HUB', 'MW'],
+                     dtype={'INTERVALSTARTTIME_GMT': str, 'RENEWABLE_TYPE': 'category',
+                            'TRADING_HUB': 'category', 'MW': 'float64'})
     df = df[['INTERVALSTARTTIME_GMT', 'RENEWABLE_TYPE', 'TRADING_HUB', 'MW']]
     df = df[(df['RENEWABLE_TYPE'] == type) & (df['TRADING_HUB'] == 'NP15')]
-    df['datetime'] = pd.to_datetime(df['INTERVALSTARTTIME_GMT'])
+    df['datetime'] = pd.to_datetime(df['INTERVALSTARTTIME_GMT'], format=GRID_TIME_FORMAT, utc=True)
     df['datetime'] = df['datetime'].dt.tz_convert('America/Los_Angeles')
     df.drop(columns=['INTERVALSTARTTIME_GMT', 'RENEWABLE_TYPE', 'TRADING_HUB'], inplace=True)
     df.sort_values(by='datetime', inplace=True)
     return df
 
-def get_grid_renew(filepaths, type):
+def get_grid_renew(filepaths, type, cache_dir=None, workers=None, compact=False):
     # Get all CSV file paths from the folder
 
     filepaths = glob.glob(filepaths)
 
     # Process each CSV file and collect the DataFrames
-    dfs = [read_grid_renew(filepath, type) for filepath in filepaths]
+    reader = partial(read_grid_renew, type=type)
+    if cache_dir is not None:
+        reader = partial(read_cached, tag='renew|{}'.format(type), reader=reader, cache_dir=cache_dir)
+    dfs = read_files(filepaths, reader, workers)
 
     # Combine all DataFrames vertically
     combined_df = pd.concat(dfs, ignore_index=True)
@@ -232,9 +396,112 @@ def get_grid_renew(filepaths, type):
     combined_df.reset_index(inplace=True)
     combined_df.columns = ['datetime', type]
 
+    if compact:
+        combined_df = compact_frame(combined_df)
+
     return combined_df
 
+# Define the function to process a single CSV file for every renewable type
+def read_grid_renew_all(filepath, hubs=('NP15',)):
+
+    df = pd.read_csv(filepath,
+                     usecols=['INTERVALSTARTTIME_GMT', 'RENEWABLE_TYPE', 'TRADING_HUB', 'MW'],
+                     dtype={'INTERVALSTARTTIME_GMT': str, 'RENEWABLE_TYPE': 'category',
+                            'TRADING_HUB': 'category', 'MW': 'float64'})
+    df = df[df['TRADING_HUB'].isin(hubs)]
+    df['datetime'] = pd.to_datetime(df['INTERVALSTARTTIME_GMT'], format=GRID_TIME_FORMAT, utc=True)
+    df['datetime'] = df['datetime'].dt.tz_convert('America/Los_Angeles')
+    df = df[['datetime', 'RENEWABLE_TYPE', 'TRADING_HUB', 'MW']]
+    return df
+
+def get_grid_renew_wide(filepaths, hubs=('NP15',), cache_dir=None, workers=None, compact=False):
+    # Read every renewables file once and pivot all RENEWABLE_TYPEs into one
+    # datetime-indexed frame. Columns are the type names for a single hub
+    # (as in get_grid_renew) and <type>_<hub> for several hubs
+
+    filepaths = glob.glob(filepaths)
+
+    reader = partial(read_grid_renew_all, hubs=tuple(hubs))
+    if cache_dir is not None:
+        reader = partial(read_cached, tag='renew_all|{}'.format(','.join(hubs)), reader=reader, cache_dir=cache_dir)
+    combined_df = pd.concat(read_files(filepaths, reader, workers), ignore_index=True)
+
+    combined_df['RENEWABLE_TYPE'] = combined_df['RENEWABLE_TYPE'].astype(str)
+    combined_df['TRADING_HUB'] = combined_df['TRADING_HUB'].astype(str)
+    wide_df = combined_df.pivot_table(index='datetime', columns=['RENEWABLE_TYPE', 'TRADING_HUB'], values='MW', aggfunc='mean')
+
+    if len(hubs) == 1:
+        wide_df.columns = wide_df.columns.get_level_values(0)
+    else:
+        wide_df.columns = ['{}_{}'.format(ty, hub) for ty, hub in wide_df.columns]
+    wide_df.columns.name = None
+
+    if compact:
+        wide_df = compact_frame(wide_df)
+
+    return wide_df
+
+def fill_daily(df, max_gap=None):
+    # Vectorized replacement for groupby(date).apply(process_group) on a
+    # time-sorted frame ('datetime' column or DatetimeIndex). Days where every
+    # numeric column is NaN are dropped and the rest is interpolated linearly
+    # within each day, as interpolate(method='linear'): leading NaNs of a day
+    # stay, NaNs after its last value repeat it. max_gap (rows) leaves longer
+    # gaps empty. Every column of every day is handled in one pass over the
+    # rows x columns array, only the missing cells are computed
+    times = pd.DatetimeIndex(df['datetime'] if 'datetime' in df.columns else df.index)
+    numeric = [col for col in df.select_dtypes('number').columns if col != 'datetime']
+    # columns x rows, so every column is one contiguous run of the flat array
+    values = np.array(df[numeric].to_numpy(dtype=float).T, order='C')
+    n_cols, n = values.shape
+
+    # Row span [start, end) of the day of every row
+    midnight = times.normalize().asi8
+    starts = np.flatnonzero(np.r_[True, midnight[1:] != midnight[:-1]])
+    lengths = np.diff(np.r_[starts, n])
+    day_start = np.repeat(starts, lengths)
+    day_end = np.repeat(starts + lengths, lengths)
+
+    # Previous / next valid cell of every cell in the flat array. A day never
+    # spans two columns, so the day bounds below also stop at column edges
+    flat = values.ravel()
+    valid = ~np.isnan(flat)
+    cell = np.arange(flat.size, dtype=np.int64 if flat.size > 2 ** 31 - 2 else np.int32)
+    prev = np.maximum.accumulate(np.where(valid, cell, -1))
+    nxt = np.minimum.accumulate(np.where(valid, cell, flat.size)[::-1])[::-1]
+
+    missing = np.flatnonzero(~valid)
+    col, r = np.divmod(missing, n) if n else (missing, missing)
+    base = col * n
+    p, q = prev[missing], nxt[missing]
+    has_next = q < base + day_end[r]
+    fill = p >= base + day_start[r]
+    if max_gap is not None:
+        fill &= np.where(has_next, q, base + day_end[r]) - p - 1 <= max_gap
+    missing, p, q, has_next = missing[fill], p[fill], q[fill], has_next[fill]
+
+    prev_value = flat[p]
+    next_value = flat[np.where(has_next, q, p)]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        flat[missing] = np.where(has_next, prev_value + (next_value - prev_value) * (missing - p) / (q - p), prev_value)
+
+    empty_row = ~valid.reshape(n_cols, n).any(axis=0)
+    empty_day = np.logical_and.reduceat(empty_row, starts) if n else np.array([], dtype=bool)
+    keep = ~np.repeat(empty_day, lengths)
+
+    # Same columns and dtypes as df (int columns have no NaN, so nothing was
+    # filled in them)
+    if not keep.all():
+        values = values[:, keep]
+    out = pd.DataFrame(values.T, index=df.index[keep], columns=numeric, copy=False)
+    for i, col in enumerate(df.columns):
+        if col not in out.columns:
+            out.insert(i, col, df[col].array[keep])
+    narrow = {col: df[col].dtype for col in numeric if df[col].dtype != np.float64}
+    return out.astype(narrow) if narrow else out
+
 def process_group(group):
+    # Per-day version for groupby(date).apply, fill_daily() does all days at once
     # Check if all values in the group are NaN
     if group.isnull().all().all():  # checks all columns; use group['values'].isnull().all() for a specific column
         return None  # Return None if there are no valid entries for the entire day
@@ -4,6 +4,18 @@ import numpy as np
 import seaborn as sns
 import matplotlib.dates as mdates
 from matplotlib.ticker import MultipleLocator
+from .utils_get import parse_times
+
+def _plot_tz(df, tz):
+    # Frame and time zone for the date ticks. tz-aware times are converted to
+    # tz, or keep their own zone when tz is '', and the ticks use that zone;
+    # matplotlib would label them in UTC otherwise. Naive times are left as is
+    times = df['datetime']
+    if times.dt.tz is None:
+        return df, tz
+    if tz:
+        times = times.dt.tz_convert(tz)
+    return df.assign(datetime=times), times.dt.tz
 
 def make_plot(df, 
               axe, 
@@ -21,12 +33,17 @@ def make_plot(df,
               legend=[]):
     
     if dual_columns:
-        df['datetime'] = pd.to_datetime(df.iloc[:, 0])
+        # frames from read_timeseries() are already parsed
+        if pd.api.types.is_datetime64_any_dtype(df.iloc[:, 0]):
+            df['datetime'] = df.iloc[:, 0]
+        else:
+            df['datetime'] = parse_times(df.iloc[:, 0].values, tz or 'America/Los_Angeles').array
 
         if columns == []:
             columns = df.columns[1:]
 
         if date:
+            df, tz = _plot_tz(df, tz)
             df = df[df['datetime'].dt.date == pd.to_datetime(date)]
             axe.xaxis.set_major_locator(mdates.HourLocator(byhour=range(0, 24, 6), tz = tz))
             axe.xaxis.set_major_formatter(mdates.DateFormatter('%-I %p', tz = tz))
@@ -70,6 +87,7 @@ def make_plot(df,
             columns = df.columns[1:]
 
         if date:
+            df, tz = _plot_tz(df, tz)
             df = df[df['datetime'].dt.date == pd.to_datetime(date)]
             axe.xaxis.set_major_locator(mdates.HourLocator(byhour=range(0, 24, 6), tz = tz))
             axe.xaxis.set_major_formatter(mdates.DateFormatter('%-I %p', tz = tz)) 
@@ -104,12 +122,19 @@ def plot_hourly_heatmap(df,
                         plot_title = '', 
                         cbar_ticks = [], 
                         cbar_label = [], 
-                        figsize = ()):
-    
-    df['datetime'] = pd.to_datetime(df['datetime']) 
+                        figsize = (),
+                        tz = 'America/Los_Angeles'):
+
+    # Hours are binned on the clock of tz: naive times are taken as wall
+    # clock in tz and tz-aware ones (moer_15, stored in UTC) are converted,
+    # so the 12 AM column is local midnight
+    if not pd.api.types.is_datetime64_any_dtype(df['datetime']):
+        df['datetime'] = parse_times(df['datetime'].values, tz).array
+    elif df['datetime'].dt.tz is not None:
+        df['datetime'] = df['datetime'].dt.tz_convert(tz)
     df.set_index('datetime', inplace=True)
     
-    hourly_data = df[columns].resample('H').mean()
+    hourly_data = df[columns].resample(pd.offsets.Hour()).mean()
     
     heatmap_data = hourly_data.pivot_table(index=hourly_data.index.date, 
                                            columns=hourly_data.index.hour, 
@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+
+# Bit of each check in the flags returned by scan_quality()
+QUALITY_FLAGS = {
+    "gap": 1,       # no value, the 15-minute bin had no samples
+    "stuck": 2,     # part of a long run of identical values
+    "range": 4,     # outside the column's valid range
+    "spike": 8,     # jumps away from both neighbours and back
+}
+
+def _value_columns(df):
+    return [col for col in df.select_dtypes('number').columns if col != 'datetime']
+
+def stuck_runs(values, min_run, off=None):
+    # values is columns x rows. True for every cell in a run of at least
+    # min_run identical, non-NaN values. off holds one value per column (NaN:
+    # none) that is a normal resting state, e.g. 0 for a fan that is off, and
+    # runs at it are not flagged. The runs are found for all columns at once
+    # on the flattened array, every column start also starts a run
+    n_cols, n = values.shape
+    if values.size == 0:
+        return np.zeros(values.shape, dtype=bool)
+    flat = values.ravel()
+    start = np.empty(flat.size, dtype=bool)
+    start[:1] = True
+    start[1:] = flat[1:] != flat[:-1]       # NaN != NaN, so NaNs are runs of 1
+    start[::n] = True
+    run_id = np.cumsum(start) - 1
+    lengths = np.diff(np.r_[np.flatnonzero(start), flat.size])
+    stuck = ((lengths[run_id] >= min_run) & ~np.isnan(flat)).reshape(n_cols, n)
+    if off is not None:
+        stuck &= values != np.asarray(off, dtype=float)[:, None]
+    return stuck
+
+def spikes(values, z):
+    # values is columns x rows. True where a value sits on the same side of
+    # both neighbours by more than z standard deviations of the column's step
+    # changes (estimated as 1.2533 x their mean absolute value; the median is
+    # ~0 for quantized sensors that mostly hold). Level shifts, where only one
+    # neighbour differs, are not spikes
+    step = np.diff(values, axis=1)
+    with np.errstate(invalid='ignore'):
+        size = np.abs(step)
+        count = (~np.isnan(size)).sum(axis=1, keepdims=True)
+        scale = 1.2533 * np.nansum(size, axis=1, keepdims=True) / count
+        rise, fall = step[:, :-1], -step[:, 1:]         # x[t] - x[t-1], x[t] - x[t+1]
+        jump = np.where(rise * fall > 0, np.minimum(np.abs(rise), np.abs(fall)), 0)
+        flagged = np.zeros(values.shape, dtype=bool)
+        flagged[:, 1:-1] = (jump > z * scale) & (scale > 0)
+    return flagged
+
+def scan_quality(df, stuck_steps=24, ranges=None, spike_z=8.0, off_value=0.0):
+    # Quality flags for every value of a cleaned frame (clean_df / download_df
+    # output: 'datetime' plus one column per point). Returns a frame of the
+    # same shape with 'datetime' and, per column, the OR of the QUALITY_FLAGS
+    # bits raised:
+    #   gap    NaN
+    #   stuck  run of at least stuck_steps identical values (24 = 6 hours),
+    #          except runs at off_value: equipment that is off (a fan at 0
+    #          CFM overnight) holds it legitimately. off_value is one value
+    #          for every column, a {col: value} dict (other columns have no
+    #          off value) or None to flag every run
+    #   range  outside ranges[col] = (low, high), for the columns given
+    #   spike  isolated jump of more than spike_z robust standard deviations
+    #          (see spikes)
+    cols = _value_columns(df)
+    values = np.array(df[cols].to_numpy(dtype=float).T, order='C')
+    flags = np.zeros(values.shape, dtype=np.uint8)
+
+    flags |= np.isnan(values).astype(np.uint8) * QUALITY_FLAGS["gap"]
+    if isinstance(off_value, dict):
+        off = [off_value.get(col, np.nan) for col in cols]
+    else:
+        off = [np.nan if off_value is None else off_value] * len(cols)
+    flags |= stuck_runs(values, stuck_steps, off).astype(np.uint8) * QUALITY_FLAGS["stuck"]
+
+    if ranges:
+        low = np.array([ranges.get(col, (-np.inf, np.inf))[0] for col in cols], dtype=float)[:, None]
+        high = np.array([ranges.get(col, (-np.inf, np.inf))[1] for col in cols], dtype=float)[:, None]
+        with np.errstate(invalid='ignore'):
+            flags |= ((values < low) | (values > high)).astype(np.uint8) * QUALITY_FLAGS["range"]
+
+    flags |= spikes(values, spike_z).astype(np.uint8) * QUALITY_FLAGS["spike"]
+
+    result = pd.DataFrame(flags.T, index=df.index, columns=cols)
+    result.insert(0, 'datetime', df['datetime'].array)
+    return result
+
+def daily_quality(flags, max_bad=0.1, checks=tuple(QUALITY_FLAGS)):
+    # Per-day, per-column mask from scan_quality() flags: True where at most
+    # max_bad of the day's values raise any of the given checks. Indexed by
+    # the local date
+    cols = _value_columns(flags)
+    bits = sum(QUALITY_FLAGS[check] for check in checks)
+    bad = (flags[cols].to_numpy(dtype=np.uint8) & bits) != 0
+    days = pd.DatetimeIndex(flags['datetime']).normalize()
+    share = pd.DataFrame(bad, index=days, columns=cols).groupby(level=0).mean()
+    share.index = share.index.date
+    return share <= max_bad
+
+def mask_bad_days(df, day_mask):
+    # df with the values of every (day, column) failing day_mask set to NaN,
+    # so plots show gaps and shift() / fill_daily() skip them
+    cols = [col for col in day_mask.columns if col in df.columns]
+    days = pd.DatetimeIndex(df['datetime']).date
+    good = day_mask.reindex(days)[cols].fillna(False).to_numpy(dtype=bool)
+    out = df.copy()
+    out[cols] = out[cols].where(good)
+    return out
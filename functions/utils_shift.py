@@ -1,35 +1,389 @@
+import heapq
+import math
+from multiprocessing import Pool, shared_memory
+import numpy as np
+import pandas as pd
+
 # This is a function defined to do hypothetical load shift
 
-def shift(threshold, df):
+def _deposit_balance(step, high):
+    # Energy owed back to the grid (minus the deposit) after every interval.
+    # The balance only leaves zero on a charging interval, so each run from a
+    # charging interval to the next reset is accumulated with a sequential
+    # cumsum, which rounds exactly like the row-by-row loop
+    balance = np.zeros(len(step))
+    starts = np.flatnonzero(~high & (step != 0))
+    pos = 0
+
+    while True:
+        k = np.searchsorted(starts, pos)
+        if k == len(starts):
+            break
+        j = starts[k]
+        total = 0.0
+        chunk = 96
+
+        while j < len(step):
+            running = np.cumsum(np.concatenate(([total], step[j:j + chunk])))
+            prev, cur = running[:-1], running[1:]
+
+            # discharging past zero (or on a missing power value) ends the run
+            reset = high[j:j + chunk] & ~(cur > 0) & ~np.isnan(prev)
+            if reset.any():
+                r = np.argmax(reset)
+                balance[j:j + r] = cur[:r]
+                pos = j + r + 1
+                break
+
+            balance[j:j + len(cur)] = cur
+            total = cur[-1]
+            j = j + len(cur)
+            chunk = chunk * 2
+        else:
+            break
+
+    return balance
+
+def _shift_rows(threshold, moer, power, charge=1.5, discharge=0.3):
+    # Time-major (time, rows) version of shift_array() that advances every
+    # row of the deposit state machine one interval at a time
+    low = moer <= threshold
+    high = moer > threshold
+    shape = np.broadcast_shapes(low.shape, power.shape)
+    low = np.broadcast_to(low, shape)
+    high = np.broadcast_to(high, shape)
+    deposit_rate = power * (charge - 1)
+    discharge_rate = power * discharge
+
+    balance = np.empty(shape)
+    w = np.zeros(shape[1])
+    for t in range(shape[0]):
+        hi = high[t] & (w > 0)
+        full = hi & (w >= discharge_rate[t])
+        w = np.where(low[t], w + deposit_rate[t], np.where(full, w - discharge_rate[t], np.where(hi, 0.0, w)))
+        balance[t] = w
+
+    prev = np.concatenate((np.zeros((1, shape[1])), balance[:-1]))
 
     # Chiller 30% setpoint reset
-    potential_power = []
-    i = 0
-    deposit = 0
-    deposit_list = []
-    activation = 0
+    discharging = high & (prev > 0)
+    full = discharging & (prev >= discharge_rate)
+    potential_power = np.where(low, power * charge,
+                      np.where(full, power * (1 - discharge),
+                      np.where(discharging, power - prev, power)))
 
-    df = df.reset_index(drop=True)
-    while i < len(df):
-        if df['moer'][i] <= threshold:
-            potential_power.append(df["predicted_power"][i] * 1.5)
-            deposit = deposit - df["predicted_power"][i] * 0.5
-            activation = activation + 1
-            deposit_list.append(deposit)
-        elif df['moer'][i] > threshold and deposit < 0:
-            if deposit <= -df["predicted_power"][i] * 0.3:
-                potential_power.append(df["predicted_power"][i] * 0.7)
-                deposit = deposit + df["predicted_power"][i] * 0.3
-                deposit_list.append(deposit)
+    return potential_power, 0.0 - balance, low
+
+def shift_array(threshold, moer, power, charge=1.5, discharge=0.3):
+    # Array version of shift(): moer and predicted power as 1-D arrays,
+    # power is expected to be non-negative. threshold is a scalar or one value
+    # per interval. charge is the power factor below the threshold, discharge
+    # the fraction of power paid back above it
+    moer = np.ascontiguousarray(moer, dtype=float)
+    power = np.ascontiguousarray(power, dtype=float)
+
+    low = moer <= threshold
+    high = moer > threshold
+    step = np.where(low, power * (charge - 1), np.where(high, -(power * discharge), 0.0))
+
+    balance = _deposit_balance(step, high)
+    prev = np.concatenate(([0.0], balance[:-1]))
+
+    # Chiller 30% setpoint reset
+    discharging = high & (prev > 0)
+    full = discharging & (prev >= power * discharge)
+    potential_power = np.where(low, power * charge,
+                      np.where(full, power * (1 - discharge),
+                      np.where(discharging, power - prev, power)))
+
+    potential_emissions = potential_power * moer / 1000
+    deposit = 0.0 - balance
+    activation = int(low.sum())
+
+    return potential_power, potential_emissions, deposit, activation
+
+def rolling_threshold(moer, window=672, quantile=0.3, min_periods=None):
+    # Trailing-window MOER quantile (same definition as pandas
+    # rolling().quantile() with linear interpolation), the default window is
+    # 7 days of 15-minute data. Two heaps split the window at the quantile
+    # position and expired values are dropped lazily, so every interval costs
+    # O(log window) instead of a sort
+    moer = np.asarray(moer, dtype=float)
+    values = moer.tolist()
+    if min_periods is None:
+        min_periods = window
+
+    lower = []  # max-heap (negated) holding the k + 1 smallest values
+    upper = []  # min-heap with the rest
+    in_lower = [False] * len(values)
+    expired = [False] * len(values)
+    count = {'lower': 0, 'upper': 0}
+
+    def prune(heap):
+        while heap and expired[heap[0][1]]:
+            heapq.heappop(heap)
+
+    def rebalance(k):
+        while count['lower'] > k + 1:
+            prune(lower)
+            v, i = heapq.heappop(lower)
+            in_lower[i] = False
+            heapq.heappush(upper, (-v, i))
+            count['lower'] -= 1
+            count['upper'] += 1
+        while count['lower'] < k + 1 and count['upper'] > 0:
+            prune(upper)
+            v, i = heapq.heappop(upper)
+            in_lower[i] = True
+            heapq.heappush(lower, (-v, i))
+            count['lower'] += 1
+            count['upper'] -= 1
+        prune(lower)
+        prune(upper)
+
+    threshold = np.full(len(values), np.nan)
+    for t, v in enumerate(values):
+        if t >= window and not math.isnan(values[t - window]):
+            expired[t - window] = True
+            count['lower' if in_lower[t - window] else 'upper'] -= 1
+
+        if not math.isnan(v):
+            prune(lower)
+            if lower and v <= -lower[0][0]:
+                heapq.heappush(lower, (-v, t))
+                in_lower[t] = True
+                count['lower'] += 1
+            else:
+                heapq.heappush(upper, (v, t))
+                count['upper'] += 1
+
+        nobs = count['lower'] + count['upper']
+        if nobs == 0:
+            continue
+        position = quantile * (nobs - 1)
+        k = int(position)
+        rebalance(k)
+
+        # drop expired entries once they outnumber the live ones
+        if len(lower) + len(upper) > 2 * nobs + 64:
+            lower[:] = [e for e in lower if not expired[e[1]]]
+            upper[:] = [e for e in upper if not expired[e[1]]]
+            heapq.heapify(lower)
+            heapq.heapify(upper)
+
+        if nobs < min_periods:
+            continue
+        low_value = -lower[0][0]
+        if position == k or k == nobs - 1:
+            threshold[t] = low_value
+        else:
+            high_value = upper[0][0]
+            threshold[t] = low_value + (high_value - low_value) * (position - k)
+
+    return threshold
+
+def shift_rolling(moer, power, window=672, quantile=0.3, min_periods=None, charge=1.5, discharge=0.3):
+    # shift_array() against a trailing-window MOER quantile instead of a fixed
+    # threshold, intervals without a threshold yet are left unshifted
+    threshold = rolling_threshold(moer, window, quantile, min_periods)
+    return shift_array(threshold, moer, power, charge, discharge)
+
+def shift_sweep(thresholds, moer, power, charge=1.5, discharge=0.3):
+    # Run shift() for every MOER threshold at once, results are
+    # thresholds x time matrices plus per-threshold totals
+    thresholds = np.asarray(thresholds, dtype=float).ravel()
+    moer = np.asarray(moer, dtype=float)
+    power = np.asarray(power, dtype=float)
+
+    potential_power, _, low = _shift_rows(thresholds, moer[:, None], power[:, None], charge, discharge)
+    potential_emissions = potential_power * moer[:, None] / 1000
+    total_emissions = np.nansum(potential_emissions, axis=0)
+
+    return {
+        'threshold': thresholds,
+        'potential_power': potential_power.T,
+        'potential_emissions': potential_emissions.T,
+        'total_emissions': total_emissions,
+        'activation': low.sum(axis=0),
+        'best_threshold': thresholds[np.argmin(total_emissions)],
+    }
+
+def shift_batch(threshold, moer, power, charge=1.5, discharge=0.3):
+    # Run shift() for a portfolio: power is assets x time, moer is shared,
+    # threshold is a scalar or one value per asset
+    threshold = np.asarray(threshold, dtype=float)
+    moer = np.asarray(moer, dtype=float)
+    power = np.ascontiguousarray(np.atleast_2d(power).T, dtype=float)
+
+    potential_power, deposit, low = _shift_rows(threshold, moer[:, None], power, charge, discharge)
+    potential_emissions = potential_power * moer[:, None] / 1000
+
+    return {
+        'potential_power': potential_power.T,
+        'potential_emissions': potential_emissions.T,
+        'deposit': deposit.T,
+        'activation': low.sum(axis=0),
+        'total_power': np.nansum(potential_power, axis=1),
+        'total_emissions': np.nansum(potential_emissions, axis=1),
+    }
+
+class ShiftController:
+    # Online version of shift(): feed one interval at a time, the state is
+    # the threshold, the deposit balance and a few running totals
+
+    def __init__(self, threshold, deposit=0.0, activation=0, emissions=0.0,
+                 charge=1.5, discharge=0.3):
+        self.threshold = threshold
+        self.charge = charge
+        self.discharge = discharge
+        self.deposit = deposit
+        self.activation = activation
+        self.emissions = emissions
+
+    def step(self, moer, predicted_power):
+        # Same branches as the shift() loop, returns the commanded power and
+        # the running emissions
+        if moer <= self.threshold:
+            power = predicted_power * self.charge
+            self.deposit = self.deposit - predicted_power * (self.charge - 1)
+            self.activation = self.activation + 1
+        elif moer > self.threshold and self.deposit < 0:
+            if self.deposit <= -predicted_power * self.discharge:
+                power = predicted_power * (1 - self.discharge)
+                self.deposit = self.deposit + predicted_power * self.discharge
             else:
-                potential_power.append(df["predicted_power"][i] + deposit)
-                deposit = 0
-                deposit_list.append(deposit)
+                power = predicted_power + self.deposit
+                self.deposit = 0.0
         else:
-            potential_power.append(df["predicted_power"][i])
-            deposit_list.append(deposit)
-        i = i + 1
+            power = predicted_power
+
+        # missing MOER or power values are skipped like in a pandas sum
+        emissions = power * moer / 1000
+        if not math.isnan(emissions):
+            self.emissions = self.emissions + emissions
+
+        return power, self.emissions
+
+    def state(self):
+        return {'threshold': self.threshold, 'deposit': self.deposit,
+                'activation': self.activation, 'emissions': self.emissions,
+                'charge': self.charge, 'discharge': self.discharge}
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(**state)
+
+def shift_optimal(moer, power, charge=1.5, discharge=0.3):
+    # Lowest-emission schedule under the same per-interval limits as shift():
+    # power between (1 - discharge) and charge times the predicted power, and
+    # energy only paid back after it was deposited. This is the balance DP of
+    # the problem solved exactly: its cost-to-go is convex and piecewise
+    # linear in the balance, with one piece per interval that can still take
+    # or give energy, so the pieces are kept in a heap ordered by MOER instead
+    # of on a grid. Each interval pays back against the cheapest earlier
+    # energy still open, either an unused deposit or an earlier pay-back that
+    # is worth moving here, in O(n log n). Returns the same outputs as
+    # shift_array()
+    moer = np.asarray(moer, dtype=float)
+    power = np.asarray(power, dtype=float)
+
+    # missing MOER or power intervals are left unshifted
+    valid = ~np.isnan(moer) & ~np.isnan(power)
+    cost = np.where(valid, moer, 0.0)
+    up = np.where(valid, power * (charge - 1), 0.0)
+    down = np.where(valid, power * discharge, 0.0)
+
+    # Heap entries are (moer, interval, energy). interval + 1 marks energy
+    # that can still be deposited there, -(interval + 1) a pay-back there
+    # that can be undone; both raise that interval's power when used
+    delta = np.zeros(len(moer))
+    heap = []
+    for t, (c, u, d) in enumerate(zip(cost.tolist(), up.tolist(), down.tolist())):
+        paid = 0.0
+        while paid < d and heap and heap[0][0] < c:
+            price, s, energy = heap[0]
+            used = min(d - paid, energy)
+            delta[abs(s) - 1] += used
+            paid += used
+            if used < energy:
+                heapq.heapreplace(heap, (price, s, energy - used))
+            else:
+                heapq.heappop(heap)
+        delta[t] -= paid
+        if paid > 0:
+            heapq.heappush(heap, (c, -(t + 1), paid))
+        if u > 0:
+            heapq.heappush(heap, (c, t + 1, u))
+
+    balance = np.cumsum(delta)
+    potential_power = power + delta
+    potential_emissions = potential_power * moer / 1000
+    deposit = 0.0 - balance
+    activation = int((delta > 0).sum())
+
+    return potential_power, potential_emissions, deposit, activation
+
+# Worker-side view of the shared MOER / power arrays for shift_grid_search()
+_grid_arrays = {}
+
+def _grid_init(name, length):
+    shm = shared_memory.SharedMemory(name=name)
+    _grid_arrays['shm'] = shm
+    _grid_arrays['data'] = np.ndarray((2, length), dtype=float, buffer=shm.buf)
+
+def _grid_task(task):
+    charge, discharge, thresholds = task
+    moer, power = _grid_arrays['data']
+
+    potential_power, _, low = _shift_rows(thresholds, moer[:, None], power[:, None], charge, discharge)
+    emissions = np.nansum(potential_power * moer[:, None] / 1000, axis=0)
+
+    return charge, discharge, thresholds, emissions, low.sum(axis=0)
+
+def shift_grid_search(moer, power, thresholds, charges=(1.5,), discharges=(0.3,), processes=None, chunk=32):
+    # Evaluate every (threshold, charge, discharge) policy on a process pool.
+    # moer and power are copied once into shared memory, each task sweeps a
+    # chunk of thresholds for one (charge, discharge) pair
+    moer = np.asarray(moer, dtype=float)
+    power = np.asarray(power, dtype=float)
+    thresholds = np.asarray(thresholds, dtype=float).ravel()
+
+    tasks = [(charge, discharge, thresholds[i:i + chunk])
+             for charge in charges
+             for discharge in discharges
+             for i in range(0, len(thresholds), chunk)]
+
+    shm = shared_memory.SharedMemory(create=True, size=2 * len(moer) * 8)
+    try:
+        data = np.ndarray((2, len(moer)), dtype=float, buffer=shm.buf)
+        data[0] = moer
+        data[1] = power
+        del data
+
+        with Pool(processes, initializer=_grid_init, initargs=(shm.name, len(moer))) as pool:
+            results = pool.map(_grid_task, tasks)
+    finally:
+        shm.close()
+        shm.unlink()
+
+    baseline = np.nansum(power * moer / 1000)
+    table = pd.DataFrame({
+        'threshold': np.concatenate([r[2] for r in results]),
+        'charge': np.concatenate([np.full(len(r[2]), r[0]) for r in results]),
+        'discharge': np.concatenate([np.full(len(r[2]), r[1]) for r in results]),
+        'emissions': np.concatenate([r[3] for r in results]),
+        'activation': np.concatenate([r[4] for r in results]),
+    })
+    table['reduction'] = baseline - table['emissions']
+    table = table.sort_values(by='reduction', ascending=False, kind='stable').reset_index(drop=True)
+
+    return table
+
+def shift(threshold, df):
+
+    df = df.reset_index(drop=True)
+    potential_power, _, deposit, activation = shift_array(threshold, df['moer'].to_numpy(), df["predicted_power"].to_numpy())
 
     potential_emissions = potential_power * df['moer'] / 1000
 
-    return potential_power, potential_emissions, deposit_list, activation
\ No newline at end of file
+    return potential_power.tolist(), potential_emissions, deposit.tolist(), activation
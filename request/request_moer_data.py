@@ -2,18 +2,31 @@
 Retreive data from WattTime API
 
 """
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import csv
+import glob
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 import requests
+from requests.adapters import HTTPAdapter
+import numpy as np
 import pandas as pd
 from requests.auth import HTTPBasicAuth
 
+WATTTIME_URL = "https://api.watttime.org"
+
 def get_intervals(start = "2022-05-01", end = "2022-09-01"):
 
     start_dt = datetime.strptime(start, '%Y-%m-%d')
     end_dt = datetime.strptime(end, '%Y-%m-%d')    
 
+    return month_intervals(start_dt, end_dt)
+
+def month_intervals(start_dt, end_dt):
+    # Month boundaries between two datetimes, formatted for the API
+
     # Create a list for each month interval
     current_dt = start_dt
     time_intervals = []
@@ -21,7 +34,7 @@ def get_intervals(start = "2022-05-01", end = "2022-09-01"):
     while current_dt < end_dt:
         # Calculate the last moment of the current month
         next_month = current_dt + timedelta(days=32)  # Add enough days to be sure we're in the next month
-        next_month = next_month.replace(day=1)  # Go to the first day of the next month
+        next_month = next_month.replace(day=1, hour=0, minute=0, second=0, microsecond=0)  # Go to the first day of the next month
         
         # Ensure we don't go beyond the end time
         if next_month > end_dt:
@@ -37,23 +50,99 @@ def get_intervals(start = "2022-05-01", end = "2022-09-01"):
 
     return time_intervals
 
-def download_raw(time_intervals, region = "CAISO_NORTH", signal_type = "co2_moer", historical = True):
-    
-    login_url = 'https://api.watttime.org/login'
-    rsp = requests.get(login_url, auth=HTTPBasicAuth('aoyuzou36', 'aoyuzou36!'))
-    TOKEN = rsp.json()['token']
-    print(rsp.json())
+def login(session = requests, base_url = WATTTIME_URL):
+    rsp = session.get(base_url + '/login', auth=HTTPBasicAuth('aoyuzou36', 'aoyuzou36!'))
+    rsp.raise_for_status()
+    return rsp.json()['token']
 
-    # get historical
-    if historical:
+def read_store(store_dir):
+    # All rows of a month-partitioned MOER store, in the moer_raw.csv layout
+    files = sorted(glob.glob(os.path.join(store_dir, '*.csv')))
+    if not files:
+        return pd.DataFrame(columns=['point_time', 'value'])
+    return pd.concat([pd.read_csv(f) for f in files], ignore_index=True)
 
-        moer = []
+def last_point_time(store_dir):
+    # Newest point_time in the store, None for an empty store. Only the last
+    # non-empty partition is read, rows cut off by an interrupted write are
+    # ignored
+    for f in sorted(glob.glob(os.path.join(store_dir, '*.csv')), reverse=True):
+        point_time = pd.to_datetime(pd.read_csv(f)['point_time'], utc=True, errors='coerce').max()
+        if not pd.isnull(point_time):
+            return point_time.to_pydatetime()
+    return None
 
-        url = "https://api.watttime.org/v3/historical"
+def append_store(store_dir, rows):
+    # Append API rows to the partition of their month, e.g. 2023-01.csv
+    os.makedirs(store_dir, exist_ok=True)
+    months = {}
+    for row in rows:
+        months.setdefault(row['point_time'][:7], []).append(row)
 
-        
-        # Provide your TOKEN here, see https://docs.watttime.org/#tag/Authentication/operation/get_token_login_get for more information
-        headers = {"Authorization": f"Bearer {TOKEN}"}
+    for month, month_rows in sorted(months.items()):
+        filename = os.path.join(store_dir, '{}.csv'.format(month))
+        new_file = not os.path.exists(filename)
+        with open(filename, 'a', newline='') as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=list(month_rows[0].keys()))
+            if new_file:
+                writer.writeheader()
+            writer.writerows(month_rows)
+
+def sync_moer(store_dir, end, start = "2023-01-01", region = "CAISO_NORTH", signal_type = "co2_moer",
+              session = None, base_url = WATTTIME_URL, token = None, workers = 4):
+    # Fetch only the intervals after the newest stored point_time and append
+    # them month by month. Every window is written as soon as it arrives, so a
+    # failed request leaves a consistent store and the next call resumes from
+    # there. session only needs a requests-like get(), base_url can point at a
+    # local stand-in server
+    if session is None:
+        session = pooled_session(workers)
+
+    TOKEN = token if token is not None else login(session, base_url)
+    headers = {"Authorization": f"Bearer {TOKEN}"}
+
+    last = last_point_time(store_dir)
+    if last is None:
+        start_dt = datetime.strptime(start, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+    else:
+        start_dt = last + timedelta(minutes=5)
+    end_dt = datetime.strptime(end, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+    if start_dt >= end_dt:
+        return 0
+
+    time_intervals = month_intervals(start_dt, end_dt)
+    added = 0
+    for data in fetch_windows(session, base_url, headers, time_intervals, region, signal_type, workers):
+
+        # windows overlap at their boundaries, keep rows newer than the store
+        rows = sorted(data, key=lambda row: row['point_time'])
+        if last is not None:
+            rows = [row for row in rows if datetime.fromisoformat(row['point_time']) > last]
+        if rows:
+            append_store(store_dir, rows)
+            last = datetime.fromisoformat(rows[-1]['point_time'])
+            added = added + len(rows)
+
+    return added
+
+def pooled_session(workers = 4):
+    # One session whose connection pool fits all concurrent requests
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def fetch_window(session, base_url, headers, params):
+    response = session.get(base_url + "/v3/historical", headers=headers, params=params)
+    response.raise_for_status()
+    return response.json()['data']
+
+def fetch_windows(session, base_url, headers, time_intervals, region, signal_type, workers = 4):
+    # Yield the parsed rows of each window in order while at most workers
+    # requests are in flight, so memory holds a few windows at a time
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
         for i in tqdm(range(len(time_intervals) - 1)):
             params = {
                 "region": region,
@@ -61,27 +150,95 @@ def download_raw(time_intervals, region = "CAISO_NORTH", signal_type = "co2_moer
                 "end": time_intervals[i + 1],
                 "signal_type": signal_type
             }
-            
-            response = requests.get(url, headers=headers, params=params)
-            response.raise_for_status()
-            moer.append(response)
-    
-    with open('../moer/moer_raw.csv', 'w', newline='') as csv_file:
-        fieldnames = moer[0].json()['data'][0].keys()
-        writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-        # Write the header
-        writer.writeheader()
-
-        for i in range(len(time_intervals) - 1):
-            data = moer[i].json()['data']
-            
-            # Write the data
-            for row in data:
-                writer.writerow(row)
-
-def moer_15(filename):
-
-    moer_df = pd.read_csv(filename)
+            pending.append(pool.submit(fetch_window, session, base_url, headers, params))
+            if len(pending) >= workers:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+def region_store(store_root, region, signal_type):
+    # Partition of one (region, signal_type) pair, e.g. <root>/CAISO_NORTH/co2_moer
+    return os.path.join(store_root, region, signal_type)
+
+def sync_regions(store_root, pairs, end, start = "2023-01-01", workers = 4, session = None, base_url = WATTTIME_URL):
+    # sync_moer() for many (region, signal_type) pairs at once on one pooled
+    # session and one login, returns the rows added per pair
+    if session is None:
+        session = pooled_session(workers)
+    TOKEN = login(session, base_url)
+
+    def sync_pair(pair):
+        region, signal_type = pair
+        return sync_moer(region_store(store_root, region, signal_type), end, start, region, signal_type,
+                         session=session, base_url=base_url, token=TOKEN, workers=1)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        added = list(pool.map(sync_pair, pairs))
+
+    return dict(zip([tuple(pair) for pair in pairs], added))
+
+def load_regions(store_root, regions, signal_type = "co2_moer", freq = '15min', factor = 0.454):
+    # Aligned region x time matrix of one signal, resampled to freq on a
+    # common UTC index (missing intervals are NaN). factor converts lbs to kg
+    # as in moer_15(). Returns the matrix, the regions and the timestamps
+    series = []
+    for region in regions:
+        df = read_store(region_store(store_root, region, signal_type))
+        values = pd.Series(df['value'].to_numpy(dtype=float),
+                           index=pd.to_datetime(df['point_time'], utc=True), name=region)
+        series.append(values.resample(freq).mean())
+
+    aligned = pd.concat(series, axis=1, join='outer')
+
+    return aligned.to_numpy().T * factor, list(regions), aligned.index
+
+def download_raw(time_intervals, region = "CAISO_NORTH", signal_type = "co2_moer", historical = True,
+                 filename = '../moer/moer_raw.csv', workers = 4, session = None, base_url = WATTTIME_URL):
+
+    if session is None:
+        session = pooled_session(workers)
+    TOKEN = login(session, base_url)
+
+    # get historical
+    if historical:
+
+        # Provide your TOKEN here, see https://docs.watttime.org/#tag/Authentication/operation/get_token_login_get for more information
+        headers = {"Authorization": f"Bearer {TOKEN}"}
+
+        # Windows are fetched concurrently and each one is written as soon as
+        # it is its turn, rows keep the order of time_intervals. Rows go to a
+        # temporary file that replaces filename only once every window is in,
+        # so a failed download leaves the previous file untouched
+        tmp_file = filename + '.tmp'
+        try:
+            with open(tmp_file, 'w', newline='') as csv_file:
+                writer = None
+                for data in fetch_windows(session, base_url, headers, time_intervals, region, signal_type, workers):
+                    if writer is None and data:
+                        writer = csv.DictWriter(csv_file, fieldnames=data[0].keys())
+                        # Write the header
+                        writer.writeheader()
+
+                    # Write the data
+                    if data:
+                        writer.writerows(data)
+        except BaseException:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+        os.replace(tmp_file, filename)
+
+def moer_15(filename, compact = False):
+
+    # filename is moer_raw.csv or a sync_moer() store directory. compact=True
+    # keeps value and moer as float32 (~7 significant digits, far finer than
+    # the signal) and records memory before/after in moer_df.attrs['memory'],
+    # like compact_frame() in functions/utils_get.py
+    if os.path.isdir(filename):
+        moer_df = read_store(filename)
+    else:
+        moer_df = pd.read_csv(filename)
     moer_df['datetime'] = pd.to_datetime(moer_df['point_time'])
     moer_df = moer_df.drop(columns='point_time')
     moer_df['moer'] = moer_df['value'] * 0.454
@@ -89,6 +246,81 @@ def moer_15(filename):
     moer_df = moer_df.resample('15T').mean()
     moer_df = moer_df.reset_index()
 
+    if compact:
+        before = moer_df.memory_usage(deep=True).sum()
+        moer_df = moer_df.astype({'value': np.float32, 'moer': np.float32})
+        moer_df.attrs['memory'] = {'before': int(before), 'after': int(moer_df.memory_usage(deep=True).sum())}
+
+    return moer_df
+
+# Levels of the MOER pyramid, named like the pandas aliases used elsewhere.
+# Calendar offsets, so 'D' bins run from local midnight to midnight (23 or 25
+# hours on DST changes) once the index is in the pyramid's time zone
+MOER_LEVELS = {
+    '5T': pd.offsets.Minute(5),
+    '15T': pd.offsets.Minute(15),
+    'H': pd.offsets.Hour(),
+    'D': pd.offsets.Day(),
+}
+
+def _source_signature(source):
+    # Path, size and mtime of moer_raw.csv or of every partition of a store
+    files = sorted(glob.glob(os.path.join(source, '*.csv'))) if os.path.isdir(source) else [source]
+    signature = []
+    for f in files:
+        stat = os.stat(f)
+        signature.append('{}|{}|{}'.format(os.path.abspath(f), stat.st_size, stat.st_mtime_ns))
+    return np.array(signature)
+
+def build_moer_pyramid(source, cache_file, tz = 'America/Los_Angeles'):
+    # Parse the raw MOER once and keep 5-minute, 15-minute, hourly and daily
+    # mean / min / max levels (lb conversion applied) in one .npz file. Bins
+    # are aligned in tz (hours and days of the local clock), timestamps are
+    # stored as UTC with tz kept in '__tz__'
+    raw_df = read_store(source) if os.path.isdir(source) else pd.read_csv(source)
+    index = pd.DatetimeIndex(pd.to_datetime(raw_df['point_time'], utc=True)).tz_convert(tz)
+    value = pd.Series(raw_df['value'].to_numpy(dtype=float), index=index)
+    moer = value * 0.454
+
+    arrays = {'__source__': _source_signature(source), '__tz__': np.array(tz)}
+    for level, step in MOER_LEVELS.items():
+        value_level = value.resample(step).mean()
+        moer_level = moer.resample(step).agg(['mean', 'min', 'max'])
+        arrays[level + '_datetime'] = moer_level.index.tz_convert('UTC').tz_localize(None).to_numpy()
+        arrays[level + '_value'] = value_level.to_numpy()
+        arrays[level + '_moer'] = moer_level['mean'].to_numpy()
+        arrays[level + '_moer_min'] = moer_level['min'].to_numpy()
+        arrays[level + '_moer_max'] = moer_level['max'].to_numpy()
+
+    tmp_file = cache_file[:-4] + '.tmp.npz'
+    np.savez(tmp_file, **arrays)
+    os.replace(tmp_file, cache_file)
+
+def load_moer_level(cache_file, level = '15T', source = None, tz = 'America/Los_Angeles'):
+    # One level of the pyramid as a frame (datetime in the pyramid's tz,
+    # value, moer, moer_min, moer_max). With a source the pyramid is rebuilt
+    # first if the raw data changed since it was built or it was binned in
+    # another tz
+    if source is not None:
+        stale = True
+        if os.path.exists(cache_file):
+            with np.load(cache_file) as cached:
+                stale = ('__tz__' not in cached.files or str(cached['__tz__']) != tz
+                         or not np.array_equal(cached['__source__'], _source_signature(source)))
+        if stale:
+            build_moer_pyramid(source, cache_file, tz)
+
+    with np.load(cache_file) as cached:
+        # pyramids built before '__tz__' was stored were binned in UTC
+        stored_tz = str(cached['__tz__']) if '__tz__' in cached.files else 'UTC'
+        moer_df = pd.DataFrame({
+            'datetime': pd.to_datetime(cached[level + '_datetime']).tz_localize('UTC').tz_convert(stored_tz),
+            'value': cached[level + '_value'],
+            'moer': cached[level + '_moer'],
+            'moer_min': cached[level + '_moer_min'],
+            'moer_max': cached[level + '_moer_max'],
+        })
+
     return moer_df
 
 if __name__ == "__main__":
@@ -1,16 +1,96 @@
+import hashlib
+import os
+import pickle
 import brickschema
 from tqdm import tqdm
 from smap.archiver.client import SmapClient
 from smap.contrib import dtutil
 import pandas as pd
+from utils_smap import align_streams, fetch_resampled, load_tags, tag_table
+
+# How each point class hangs off the AHU
+POINT_PATHS = {
+    "ahu": """?ahu            brick:hasPoint                  ?sensor .""",
+    "zone": """?zone           rdf:type                        brick:HVAC_Zone .
+            ?ahu            brick:feeds                     ?vav .
+            ?vav            rdf:type                        brick:VAV .
+            ?vav            brick:feeds                     ?zone .
+            ?zone           brick:hasPoint                  ?sensor .""",
+}
+
+# query_type -> (Brick point class, path from the AHU)
+QUERY_TYPES = {
+    "sat": ("Supply_Air_Temperature_Sensor", "ahu"),
+    "zoneT": ("Zone_Air_Temperature_Sensor", "zone"),
+    "afr": ("Supply_Air_Flow_Sensor", "ahu"),
+    "fan_energy": ("Demand_Sensor", "ahu"),
+}
+
+def point_query(point_class, path="ahu"):
+    return """SELECT DISTINCT ?ahu ?sensor ?bacnet_id ?bacnet_instance WHERE {{
+            ?ahu            rdf:type                        brick:AHU .
+            ?sensor         rdf:type/rdfs:subClassOf*       brick:{} .
+            {}
+            ?sensor         brick:bacnetPoint               ?bacnet_id .
+            ?bacnet_id      brick:hasBacnetDeviceInstance   ?bacnet_instance .
+            ?bacnet_id      brick:hasBacnetDeviceType       ?bacnet_type .
+            ?bacnet_id      brick:accessedAt                ?bacnet_net .
+            ?bacnet_net     sdh:connstring                  ?bacnet_addr .
+        }}""".format(point_class, POINT_PATHS[path])
+
+def file_hash(filename):
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def load_graph(ttl_file, cache_dir='brick_cache', ttl_hash=None):
+    # Parsed graph pickled under the TTL content hash, the TTL is only parsed
+    # again when its content changes. The pickle comes back as a plain
+    # rdflib.Graph, so its store (triples and namespaces) is wrapped in a
+    # brickschema.Graph again to keep expand(), validate() etc.
+    ttl_hash = ttl_hash or file_hash(ttl_file)
+    cache_file = os.path.join(cache_dir, ttl_hash + '.graph.pickle')
+    if os.path.exists(cache_file):
+        with open(cache_file, 'rb') as f:
+            cached = pickle.load(f)
+        return brickschema.Graph(store=cached.store, identifier=cached.identifier)
+
+    g = brickschema.Graph()
+    g.load_file(ttl_file)
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(cache_file + '.tmp', 'wb') as f:
+        pickle.dump(g, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(cache_file + '.tmp', cache_file)
+    return g
+
+def query_points(ttl_file, query_text, cache_dir='brick_cache'):
+    # SPARQL result as strings, cached by TTL content hash and query text. The
+    # graph is only loaded on a cache miss
+    ttl_hash = file_hash(ttl_file)
+    key = hashlib.sha256((ttl_hash + query_text).encode()).hexdigest()
+    cache_file = os.path.join(cache_dir, key + '.csv')
+    if os.path.exists(cache_file):
+        return pd.read_csv(cache_file, dtype=str)
+
+    g = load_graph(ttl_file, cache_dir, ttl_hash)
+    query = g.query(query_text)
+    df = pd.DataFrame([[None if v is None else str(v) for v in row] for row in query],
+                      columns=[str(s) for s in query.vars])
+    os.makedirs(cache_dir, exist_ok=True)
+    df.to_csv(cache_file + '.tmp', index=False)
+    os.replace(cache_file + '.tmp', cache_file)
+    return df
 
 def get_paths_from_tags(tags):
-    paths = {key: tags[key]["Path"] for key in tags}
-    paths = pd.DataFrame.from_dict(paths, orient='index', columns=['path'])
+    # tags is the raw tag dictionary or the table from load_tags()
+    paths = tag_table(tags)[['Path']].rename(columns={'Path': 'path'})
+    paths.index.name = None
     new_cols = ["empty", "site", "device_number", "point_name", "bacnet_instance", "property_name"]
 
     # adjustments to dataframe
-    paths[new_cols] = paths.path.str.split("/", expand=True)
+    paths[new_cols] = paths.path.astype(str).str.split("/", n=len(new_cols) - 1, expand=True, regex=False)
     paths = paths.drop(columns=["empty"])
     paths['point_name'] = paths['point_name'].str.replace('SDH.', '', regex=False)
     paths['point_name'] = paths['point_name'].str.replace('[^a-zA-Z0-9]', '_', regex=True)
@@ -20,108 +100,41 @@ def get_data_from_smap(points_to_download, paths, smap_client, start, end):
     df_combine = pd.merge(paths.reset_index(), points_to_download, how='inner', on=['bacnet_instance', 'point_name'])
     df_combine = df_combine[df_combine['property_name'] == 'presentValue']
 
-    # combine the data frames
-
-    # get data from smap
-    data = smap_client.data_uuid(df_combine["index"], start, end, cache=False)
+    # get data from smap in (uuid batch x time window) chunks, each chunk is
+    # folded into the 15-minute means as it arrives
+    data = fetch_resampled(smap_client, df_combine["index"], start, end, names=df_combine['point_name'].values)
     return df_combine, data
 
-def clean_df(data, points_to_download, query):
-    df_datetime = pd.DataFrame(data[0][:, 0], columns=['datetime'])
+def download_resampled_from_smap(points_to_download, paths, smap_client, start, end, query):
+    df_combine, df_merge = get_data_from_smap(points_to_download, paths, smap_client, start, end)
 
-    # Iterate over data and uuid to extract values and create separate DataFrames, then concatenate them
-    df_values = pd.concat([pd.DataFrame(data[i][:, 1], columns=[points_to_download['point_name'].values[i]]) for i in range(0, len(points_to_download))], axis=1)
+    # Save DataFrame to a CSV file
+    df_merge.to_csv('../readfiles/ls_ctr/{}'.format(query), index=False)
+    return df_combine
 
-    # Combine datetime and values DataFrames
-    df_merge = pd.concat([df_datetime, df_values], axis=1)
-    
-    df_merge['datetime'] = pd.to_datetime(df_merge.iloc[:, 0], unit='ms', utc=True).dt.tz_convert('US/Pacific').dt.tz_localize(None)
-    df_merge.set_index('datetime', inplace=True)
-    df_merge = df_merge.resample('15T').mean()
-    df_merge = df_merge.reset_index()
+def clean_df(data, points_to_download, query):
+    # Align every stream on its own timestamps onto one 15-minute grid
+    df_merge, coverage = align_streams(data, points_to_download['point_name'].values)
 
     # Save DataFrame to a CSV file
     df_merge.to_csv('../readfiles/ls_ctr/{}'.format(query), index=False)
+    return coverage
 
 if __name__ == "__main__":
 
     start = dtutil.dt2ts(dtutil.strptime_tz("2023-01-01", "%Y-%m-%d"))
     end = dtutil.dt2ts(dtutil.strptime_tz("2024-01-01", "%Y-%m-%d"))
     query_type = "fan_energy"
-    g = brickschema.Graph()
-    g.load_file('2022_sdh_brick_expanded.ttl')
     url = "http://178.128.64.40:8079"
     keyStr = "B7qm4nnyPVZXbSfXo14sBZ5laV7YY5vjO19G"
     where = "Metadata/SourceName = 'Field Study 5a'"
 
-    # Query for zone supply temperature and return temperature
-    if query_type == "sat":
-
-        query = g.query(
-            """SELECT DISTINCT ?ahu ?sensor ?bacnet_id ?bacnet_instance WHERE {
-            ?ahu            rdf:type                        brick:AHU .
-            ?sensor         rdf:type/rdfs:subClassOf*       brick:Supply_Air_Temperature_Sensor .
-            ?ahu            brick:hasPoint                  ?sensor .
-            ?sensor         brick:bacnetPoint               ?bacnet_id .
-            ?bacnet_id      brick:hasBacnetDeviceInstance   ?bacnet_instance .
-            ?bacnet_id      brick:hasBacnetDeviceType       ?bacnet_type .
-            ?bacnet_id      brick:accessedAt                ?bacnet_net .
-            ?bacnet_net     sdh:connstring                  ?bacnet_addr .
-        }"""
-        )
-    
-    elif query_type == "zoneT":
-        
-        query = g.query(
-            """SELECT DISTINCT ?ahu ?sensor ?bacnet_instance ?bacnet_id WHERE {
-            ?ahu            rdf:type                        brick:AHU .
-            ?zone           rdf:type                        brick:HVAC_Zone .
-            ?sensor         rdf:type/rdfs:subClassOf*       brick:Zone_Air_Temperature_Sensor .
-            ?ahu            brick:feeds                     ?vav .
-            ?vav            rdf:type                        brick:VAV .
-            ?vav            brick:feeds                     ?zone .
-            ?zone           brick:hasPoint                  ?sensor .
-            ?sensor         brick:bacnetPoint               ?bacnet_id .
-            ?bacnet_id      brick:hasBacnetDeviceInstance   ?bacnet_instance .
-            ?bacnet_id      brick:hasBacnetDeviceType       ?bacnet_type .
-            ?bacnet_id      brick:accessedAt                ?bacnet_net .
-            ?bacnet_net     sdh:connstring                  ?bacnet_addr .
-        }"""
-        )
-
-    elif query_type == "afr":
-
-        query = g.query(
-            """SELECT DISTINCT ?ahu ?sensor ?bacnet_id ?bacnet_instance WHERE {
-            ?ahu            rdf:type                        brick:AHU .
-            ?sensor         rdf:type/rdfs:subClassOf*       brick:Supply_Air_Flow_Sensor .
-            ?ahu            brick:hasPoint                  ?sensor .
-            ?sensor         brick:bacnetPoint               ?bacnet_id .
-            ?bacnet_id      brick:hasBacnetDeviceInstance   ?bacnet_instance .
-            ?bacnet_id      brick:hasBacnetDeviceType       ?bacnet_type .
-            ?bacnet_id      brick:accessedAt                ?bacnet_net .
-            ?bacnet_net     sdh:connstring                  ?bacnet_addr .
-        }"""
-        )
-
-    elif query_type == "fan_energy":
-
-        query = g.query(
-            """SELECT DISTINCT ?ahu ?sensor ?bacnet_id ?bacnet_instance WHERE {
-            ?ahu            rdf:type                        brick:AHU .
-            ?sensor         rdf:type/rdfs:subClassOf*       brick:Demand_Sensor .
-            ?ahu            brick:hasPoint                  ?sensor .
-            ?sensor         brick:bacnetPoint               ?bacnet_id .
-            ?bacnet_id      brick:hasBacnetDeviceInstance   ?bacnet_instance .
-            ?bacnet_id      brick:hasBacnetDeviceType       ?bacnet_type .
-            ?bacnet_id      brick:accessedAt                ?bacnet_net .
-            ?bacnet_net     sdh:connstring                  ?bacnet_addr .
-        }"""
-        )
-    
+    # Query the AHU points of the requested class, e.g. zone air temperature
+    # for zoneT or supply air temperature for sat
+    point_class, path = QUERY_TYPES[query_type]
+    df = query_points('2022_sdh_brick_expanded.ttl', point_query(point_class, path))
 
-    print("Return {} queries".format(len(query)))
-    df = pd.DataFrame(query, columns=[str(s) for s in query.vars])
+    print("Return {} queries".format(len(df)))
     point_name = []
     for i in range(len(df)):
         point_name.append(df.sensor.str.split("/", expand=False)[i][4].split("#")[1])
@@ -130,8 +143,7 @@ if __name__ == "__main__":
     df['point_name'] = df['point_name'].str.replace('[^a-zA-Z0-9]', '_', regex=True)
     smap_client = SmapClient(url, key=keyStr)
     # import pdb; pdb.set_trace()
-    tags = smap_client.tags(where, asdict=True)
+    tags = load_tags(smap_client, where, cache_file='smap_tags.pkl')
     paths = get_paths_from_tags(tags)
-    points_to_download, data = get_data_from_smap(df, paths, smap_client, start, end)
-    print("Return {} data sources".format(len(data)))
-    clean_df(data, points_to_download, '{}.csv'.format(query_type))
\ No newline at end of file
+    points_to_download = download_resampled_from_smap(df, paths, smap_client, start, end, '{}.csv'.format(query_type))
+    print("Return {} data sources".format(len(points_to_download)))
\ No newline at end of file
@@ -13,6 +13,7 @@ sys.path.append("/mnt/c/Users/duar3/Documents/github/smap/python/smap")
 
 from smap.archiver.client import SmapClient
 from smap.contrib import dtutil
+from utils_smap import align_streams, fetch_resampled, load_tags, tag_table
 
 # create plots
 from bokeh.palettes import Spectral8, Category20
@@ -23,12 +24,13 @@ from bokeh.models import ColumnDataSource, RangeTool, LinearAxis, Range1d, BoxAn
 
 
 def get_paths_from_tags(tags):
-    paths = {key: tags[key]["Path"] for key in tags}
-    paths = pd.DataFrame.from_dict(paths, orient='index', columns=['path'])
+    # tags is the raw tag dictionary or the table from load_tags()
+    paths = tag_table(tags)[['Path']].rename(columns={'Path': 'path'})
+    paths.index.name = None
     new_cols = ["empty", "site", "device_number", "point_name", "bacnet_instance", "property_name"]
 
     # adjustments to dataframe
-    paths[new_cols] = paths.path.str.split("/", expand=True)
+    paths[new_cols] = paths.path.astype(str).str.split("/", n=len(new_cols) - 1, expand=True, regex=False)
     paths = paths.drop(columns=["empty"])
 
     return paths
@@ -37,22 +39,17 @@ def add_columns_to_df_paths(paths, tags, info_tuples):
     """
     Add more columns to the path dataframe by specifying the keywords of
     the nested dictionary found in tags. Format name as a tuple starting
-    with the preferred column name e.g. (<col_name>, 'Metadata', 'Extra', 'Description')
+    with the preferred column name e.g. (<col_name>, 'Metadata', 'Extra', 'Description').
+    tags is the raw tag dictionary or the flattened table from load_tags().
     """
+    table = tag_table(tags)
     for cur_tuple in info_tuples:
-        col_values = []
         col_name = cur_tuple[0]
-        kwords = cur_tuple[1:]
-        for point_id in paths.index:
-            cur_info = tags[point_id]
-            for kword in kwords:
-                if kword in cur_info.keys():
-                   cur_info = cur_info[kword]
-                else:
-                    cur_info = np.nan
-                    break
-            col_values.append(cur_info)
-        paths[col_name] = col_values
+        key = '/'.join(cur_tuple[1:])
+        if key in table.columns:
+            paths[col_name] = table[key].reindex(paths.index).values
+        else:
+            paths[col_name] = np.nan
 
     return paths
 
@@ -149,23 +146,18 @@ def get_uuid(file):
     return name, uuid
 
 def download_df(df, name, uuid, parameter, filename):
-    # Extract datetime from the first array and create a DataFrame
-    df_datetime = pd.DataFrame(df[0][:, 0], columns=['datetime'])
+    # Align every stream on its own timestamps onto one 15-minute grid, columns
+    # are named by point name
+    data, coverage = align_streams(df, list(name))
 
-    # Iterate over data and uuid to extract values and create separate DataFrames, then concatenate them
-    df_values = pd.concat([pd.DataFrame(df[i][:, 1], columns=[uuid[i]]) for i in range(0, len(uuid))], axis=1)
-
-    # Combine datetime and values DataFrames
-    data = pd.concat([df_datetime, df_values], axis=1)
-
-    # Change timezone
-    data['datetime'] = pd.to_datetime(data.iloc[:, 0], unit='ms', utc=True).dt.tz_convert('US/Pacific').dt.tz_localize(None)
-    data.set_index('datetime', inplace=True)
-    data = data.resample('15T').mean()
-    data = data.reset_index()
+    # Save DataFrame to a CSV file
+    data.to_csv('../readfiles/{}/{}'.format(parameter, filename), index=False)
+    return coverage
 
-    # Change column name
-    data.rename(columns = dict(zip(uuid, name)), inplace = True)
+def download_resampled(smap_client, name, uuid, start, end, parameter, filename):
+    # Chunked, concurrent version of data_uuid + download_df, the 15-minute
+    # means are built while the chunks arrive
+    data = fetch_resampled(smap_client, uuid, start, end, names=list(name))
 
     # Save DataFrame to a CSV file
     data.to_csv('../readfiles/{}/{}'.format(parameter, filename), index=False)
@@ -193,7 +185,7 @@ if __name__ == "__main__":
 
     # initiate smap client and download tags
     smap_client = SmapClient(url, key=keyStr)
-    tags = smap_client.tags(where, asdict=True)
+    tags = load_tags(smap_client, where, cache_file='smap_tags.pkl')
 
     # retrieve relevant tags from smap database
     paths = get_paths_from_tags(tags)
@@ -208,9 +200,7 @@ if __name__ == "__main__":
     # import pdb; pdb.set_trace()
 
     # data = smap_client.data_uuid(['c83051be-4074-5abf-9a32-1b6b86f1fcbf', '6507fdc4-3f09-529c-b84b-41bdf1fb572e'], start, end, cache=False)
-    data = smap_client.data_uuid(uuid, start, end, cache=False)
-
-    download_df(data, name, uuid, parameter, '{}.csv'.format(parameter))
+    download_resampled(smap_client, name, uuid, start, end, parameter, '{}.csv'.format(parameter))
 
     # import pdb; pdb.set_trace()
     # plot_multiple_entities(data, start, end, "test.html")
@@ -0,0 +1,250 @@
+"""
+Chunked sMap data retrieval and 15-minute resampling
+
+"""
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+def _local_seconds(ms, tz):
+    # Epoch milliseconds -> wall-clock seconds in tz
+    local = pd.to_datetime(ms, unit='ms', utc=True).tz_convert(tz).tz_localize(None)
+    return local.to_numpy().astype('datetime64[s]').astype(np.int64)
+
+class BinAccumulator:
+    # Running sums and counts per 15-minute bin (local wall-clock time, as in
+    # resample('15T') after the US/Pacific conversion) and per stream
+
+    def __init__(self, start, end, n_streams, step=900, tz='US/Pacific'):
+        self.step = step
+        self.tz = tz
+        first, last = _local_seconds(np.array([start, end], dtype=float) * 1000, tz)
+        self.t0 = first - first % step
+        n_bins = int((last - 1 - self.t0) // step) + 1
+        self.sums = np.zeros((n_bins, n_streams))
+        self.counts = np.zeros((n_bins, n_streams), dtype=np.int32)
+
+    def add(self, col, data):
+        # data is one [timestamp (ms), value] array returned by data_uuid
+        if len(data) == 0:
+            return
+        bins = (_local_seconds(data[:, 0], self.tz) - self.t0) // self.step
+        keep = ~np.isnan(data[:, 1]) & (bins >= 0) & (bins < len(self.sums))
+        n_bins = len(self.sums)
+        self.sums[:, col] += np.bincount(bins[keep], weights=data[keep, 1], minlength=n_bins)
+        self.counts[:, col] += np.bincount(bins[keep], minlength=n_bins)
+
+    def mean(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.counts > 0, self.sums / self.counts, np.nan)
+
+    def frame(self, names):
+        # Same layout as the cleaned CSVs: a naive local datetime column and
+        # one column per stream
+        datetime = pd.to_datetime(self.t0 + np.arange(len(self.sums)) * self.step, unit='s')
+        df = pd.DataFrame(self.mean(), columns=list(names))
+        df.insert(0, 'datetime', datetime)
+        return df
+
+def align_streams(data, names, step=900):
+    # Put every [timestamp (ms), value] stream on one common 15-minute grid,
+    # each stream is binned by its own timestamps. The sums array becomes the
+    # result in place, so the whole alignment holds a single float array.
+    # Returns the frame and the share of bins covered by each stream
+    data = [np.asarray(stream, dtype=float).reshape(-1, 2) for stream in data]
+    stamps = [stream[[0, -1], 0] for stream in data if len(stream)]
+    if not stamps:
+        return pd.DataFrame(columns=['datetime'] + list(names)), pd.Series(0.0, index=list(names))
+    start = min(s[0] for s in stamps) / 1000
+    end = max(s[1] for s in stamps) / 1000 + 1
+
+    accumulator = BinAccumulator(start, end, len(data), step)
+    for col, stream in enumerate(data):
+        accumulator.add(col, stream)
+
+    values = accumulator.sums
+    covered = accumulator.counts > 0
+    np.divide(values, accumulator.counts, out=values, where=covered)
+    values[~covered] = np.nan
+    accumulator.counts = None
+
+    datetime = pd.to_datetime(accumulator.t0 + np.arange(len(values)) * step, unit='s')
+    df = pd.DataFrame(values, columns=list(names), copy=False)
+    df.insert(0, 'datetime', datetime)
+    coverage = pd.Series(covered.mean(axis=0), index=list(names))
+
+    return df, coverage
+
+class StreamingResampler:
+    # Out-of-core 15-minute means: feed time-ordered raw samples per stream
+    # with add(), call advance() once everything before a time has been fed,
+    # and finished bins are appended to a CSV. Only the open bins are held
+    # in memory, so the export length does not matter
+
+    def __init__(self, filename, names, start, step=900, tz='US/Pacific'):
+        self.filename = filename
+        self.names = list(names)
+        self.step = step
+        self.tz = tz
+        first = _local_seconds(np.array([start * 1000.0]), tz)[0]
+        self.t0 = first - first % step
+        self.sums = np.zeros((0, len(self.names)))
+        self.counts = np.zeros((0, len(self.names)), dtype=np.int32)
+        self.header = True
+
+    def add(self, col, data):
+        # data is one [timestamp (ms), value] array of stream col
+        data = np.asarray(data, dtype=float).reshape(-1, 2)
+        data = data[~np.isnan(data[:, 1])]
+        if len(data) == 0:
+            return
+        bins = (_local_seconds(data[:, 0], self.tz) - self.t0) // self.step
+        if bins.min() < 0:
+            raise ValueError('samples before the last emitted bin, chunks must be time-ordered')
+
+        n_bins = int(bins.max()) + 1
+        if n_bins > len(self.sums):
+            grow = n_bins - len(self.sums)
+            self.sums = np.concatenate((self.sums, np.zeros((grow, len(self.names)))))
+            self.counts = np.concatenate((self.counts, np.zeros((grow, len(self.names)), dtype=np.int32)))
+
+        self.sums[:n_bins, col] += np.bincount(bins, weights=data[:, 1], minlength=n_bins)
+        self.counts[:n_bins, col] += np.bincount(bins, minlength=n_bins)
+
+    def advance(self, until):
+        # All samples before until (seconds) have been added. Bins are kept one
+        # extra hour because the fall-back DST hour repeats local times
+        local = _local_seconds(np.array([until * 1000.0]), self.tz)[0] - 3600
+        self._emit(max(0, int((local - self.t0) // self.step)))
+
+    def close(self):
+        self._emit(len(self.sums))
+
+    def _emit(self, n_done):
+        if n_done == 0:
+            return
+        if n_done > len(self.sums):
+            grow = n_done - len(self.sums)
+            self.sums = np.concatenate((self.sums, np.zeros((grow, len(self.names)))))
+            self.counts = np.concatenate((self.counts, np.zeros((grow, len(self.names)), dtype=np.int32)))
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values = np.where(self.counts[:n_done] > 0, self.sums[:n_done] / self.counts[:n_done], np.nan)
+        df = pd.DataFrame(values, columns=self.names)
+        df.insert(0, 'datetime', pd.to_datetime(self.t0 + np.arange(n_done) * self.step, unit='s'))
+        df.to_csv(self.filename, mode='w' if self.header else 'a', header=self.header, index=False)
+        self.header = False
+
+        self.sums = self.sums[n_done:].copy()
+        self.counts = self.counts[n_done:].copy()
+        self.t0 = self.t0 + n_done * self.step
+
+def fetch_to_disk(smap_client, uuids, start, end, filename, names=None, batch=20, window=7 * 86400, workers=4,
+                  retries=3, backoff=1.0):
+    # fetch_resampled() for exports that do not fit in memory: finished bins
+    # are written to filename after every time window
+    uuids = list(uuids)
+    resampler = StreamingResampler(filename, uuids if names is None else names, start)
+    windows = time_windows(start, end, window)
+    n_batches = (len(uuids) + batch - 1) // batch
+
+    chunks = fetch_chunks(smap_client, uuids, start, end, batch, window, workers, retries, backoff)
+    for k, (first, data) in enumerate(chunks):
+        for j, stream in enumerate(data):
+            resampler.add(first + j, stream)
+        if (k + 1) % n_batches == 0:
+            resampler.advance(windows[k // n_batches][1])
+
+    resampler.close()
+
+def time_windows(start, end, window):
+    # [start, end) split into windows of window seconds
+    bounds = list(range(int(start), int(end), int(window))) + [int(end)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def fetch_chunk(smap_client, uuids, start, end, retries=3, backoff=1.0):
+    # One data_uuid call, retried with exponential backoff
+    for attempt in range(retries + 1):
+        try:
+            return smap_client.data_uuid(list(uuids), start, end, cache=False)
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+def fetch_chunks(smap_client, uuids, start, end, batch=20, window=7 * 86400, workers=4, retries=3, backoff=1.0):
+    # Split the request into (uuid batch x time window) chunks and run them on
+    # a thread pool. Yields (first column of the batch, data) in a fixed order
+    # with at most workers chunks in flight
+    uuids = list(uuids)
+    chunks = [(i, start_w, end_w)
+              for start_w, end_w in time_windows(start, end, window)
+              for i in range(0, len(uuids), batch)]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for i, start_w, end_w in chunks:
+            pending.append((i, pool.submit(fetch_chunk, smap_client, uuids[i:i + batch], start_w, end_w, retries, backoff)))
+            if len(pending) >= workers:
+                i_done, future = pending.popleft()
+                yield i_done, future.result()
+
+        while pending:
+            i_done, future = pending.popleft()
+            yield i_done, future.result()
+
+def fetch_resampled(smap_client, uuids, start, end, names=None, batch=20, window=7 * 86400, workers=4,
+                    retries=3, backoff=1.0):
+    # Fetch uuids between start and end (seconds) chunk by chunk and fold every
+    # chunk into 15-minute means as it arrives. Returns the resampled frame
+    # with one column per uuid (or per name)
+    uuids = list(uuids)
+    accumulator = BinAccumulator(start, end, len(uuids))
+
+    for first, data in fetch_chunks(smap_client, uuids, start, end, batch, window, workers, retries, backoff):
+        for j, stream in enumerate(data):
+            accumulator.add(first + j, np.asarray(stream, dtype=float).reshape(-1, 2))
+
+    return accumulator.frame(uuids if names is None else names)
+
+def flatten_tags(tags):
+    # {uuid: nested tag dict} -> one row per uuid and one column per leaf key,
+    # named by its key path, e.g. 'Path', 'Metadata/Extra/Description' or
+    # 'Properties/UnitofMeasure'. Keys missing for a point are NaN
+    table = pd.json_normalize(list(tags.values()), sep='/')
+    table.index = pd.Index(list(tags.keys()), name='uuid')
+    # Repeated strings (sites, units, source names) as categoricals
+    for col in table.columns:
+        if (pd.api.types.infer_dtype(table[col], skipna=True) == 'string'
+                and table[col].nunique() < len(table) // 2):
+            table[col] = table[col].astype('category')
+    return table
+
+def tag_table(tags):
+    # Accept either the raw tag dictionary or an already flattened table
+    return tags if isinstance(tags, pd.DataFrame) else flatten_tags(tags)
+
+def load_tags(smap_client, where, cache_file=None, refresh=False, max_age=24 * 3600):
+    # Flattened tags for the where clause. Without a cache_file every call
+    # asks the archiver. With one, the table is kept there between runs and
+    # reused only for the same archiver and where clause, while the file is
+    # less than max_age seconds old (None: no age limit). refresh=True always
+    # asks the archiver. Points added to the archiver show up once the cache
+    # expires or is refreshed
+    key = {'where': where, 'archiver': getattr(smap_client, 'base', None)}
+    if cache_file is not None and not refresh and os.path.exists(cache_file):
+        if max_age is None or time.time() - os.path.getmtime(cache_file) < max_age:
+            table = pd.read_pickle(cache_file)
+            if table.attrs.get('key') == key:
+                return table
+
+    table = flatten_tags(smap_client.tags(where, asdict=True))
+    table.attrs['key'] = key
+    if cache_file is not None:
+        table.to_pickle(cache_file + '.tmp')
+        os.replace(cache_file + '.tmp', cache_file)
+    return table
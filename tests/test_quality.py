@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from functions.utils_quality import QUALITY_FLAGS, daily_quality, mask_bad_days, scan_quality, spikes, stuck_runs
+
+
+def stuck_reference(column, min_run, off=np.nan):
+    # Run-length scan of one column, one run at a time
+    stuck = np.zeros(len(column), dtype=bool)
+    i = 0
+    while i < len(column):
+        j = i + 1
+        while j < len(column) and column[j] == column[i]:
+            j += 1
+        if j - i >= min_run and not np.isnan(column[i]) and column[i] != off:
+            stuck[i:j] = True
+        i = j
+    return stuck
+
+
+def quantized_values(seed):
+    # Columns x rows of a few levels, so runs of every length show up
+    rng = np.random.default_rng(seed)
+    n_cols, n = int(rng.integers(1, 6)), int(rng.integers(1, 300))
+    levels = rng.integers(0, 3, size=(n_cols, n)).astype(float)
+    hold = rng.random((n_cols, n)) < 0.8
+    for row in range(n_cols):
+        for t in range(1, n):
+            if hold[row, t]:
+                levels[row, t] = levels[row, t - 1]
+    levels[rng.random((n_cols, n)) < 0.05] = np.nan
+    return levels, rng
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_stuck_runs_matches_run_scan(seed):
+    values, rng = quantized_values(seed)
+    min_run = int(rng.integers(1, 12))
+    off = np.where(rng.random(len(values)) < 0.5, 0.0, np.nan)
+
+    result = stuck_runs(values, min_run, off)
+
+    expected = np.array([stuck_reference(column, min_run, o) for column, o in zip(values, off)])
+    np.testing.assert_array_equal(result, expected)
+
+
+def test_stuck_runs_without_rows():
+    assert stuck_runs(np.empty((3, 0)), 4).shape == (3, 0)
+
+
+def test_stuck_runs_stop_at_column_ends():
+    # The last values of a column and the first of the next are equal but
+    # belong to different runs
+    values = np.array([[1.0, 2.0, 5.0, 5.0], [5.0, 5.0, 3.0, 4.0]])
+    assert not stuck_runs(values, 3).any()
+
+
+def test_spikes_flag_isolated_jumps_only():
+    rng = np.random.default_rng(0)
+    base = rng.normal(0, 1, 200)
+    spike, step = base.copy(), base.copy()
+    spike[100] += 50
+    step[100:] += 50
+    flat = np.full(200, 3.0)
+
+    flagged = spikes(np.array([spike, step, flat]), 8.0)
+
+    assert np.flatnonzero(flagged[0]).tolist() == [100]
+    assert not flagged[1].any()
+    assert not flagged[2].any()
+
+
+def two_days():
+    # One day of fan flow that is off overnight and one day with half of
+    # its values missing
+    times = pd.date_range('2023-06-01', periods=192, freq='15min', tz='America/Los_Angeles')
+    flow = np.where((times.hour >= 8) & (times.hour < 18), 1000.0 + np.arange(192) % 7, 0.0)
+    flow[96 + 48:] = np.nan
+    return pd.DataFrame({'datetime': times, 'flow': flow})
+
+
+def test_off_value_is_not_stuck():
+    df = two_days()
+
+    assert not (scan_quality(df)['flow'] & QUALITY_FLAGS['stuck']).any()
+    assert (scan_quality(df, off_value=None)['flow'] & QUALITY_FLAGS['stuck']).any()
+    assert not (scan_quality(df, off_value={'flow': 0.0})['flow'] & QUALITY_FLAGS['stuck']).any()
+
+
+def test_daily_mask_drops_bad_days():
+    df = two_days()
+
+    day_mask = daily_quality(scan_quality(df))
+    masked = mask_bad_days(df, day_mask)
+
+    assert day_mask['flow'].tolist() == [True, False]
+    np.testing.assert_array_equal(masked['flow'][:96], df['flow'][:96])
+    assert masked['flow'][96:].isna().all()
+    assert df['flow'][96:144].notna().all()
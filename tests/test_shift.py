@@ -0,0 +1,269 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import json
+import os
+import time
+
+from functions.utils_shift import (ShiftController, rolling_threshold, shift, shift_array, shift_batch,
+                                   shift_optimal, shift_rolling, shift_sweep)
+
+MOER_FILE = os.path.join(os.path.dirname(__file__), '..', 'readfiles', 'moer', 'moer_15.csv')
+
+
+def shift_reference(threshold, df):
+    # Row loop that shift() used before the array engine, kept as-is
+
+    # Chiller 30% setpoint reset
+    potential_power = []
+    i = 0
+    deposit = 0
+    deposit_list = []
+    activation = 0
+
+    df = df.reset_index(drop=True)
+    while i < len(df):
+        if df['moer'][i] <= threshold:
+            potential_power.append(df["predicted_power"][i] * 1.5)
+            deposit = deposit - df["predicted_power"][i] * 0.5
+            activation = activation + 1
+            deposit_list.append(deposit)
+        elif df['moer'][i] > threshold and deposit < 0:
+            if deposit <= -df["predicted_power"][i] * 0.3:
+                potential_power.append(df["predicted_power"][i] * 0.7)
+                deposit = deposit + df["predicted_power"][i] * 0.3
+                deposit_list.append(deposit)
+            else:
+                potential_power.append(df["predicted_power"][i] + deposit)
+                deposit = 0
+                deposit_list.append(deposit)
+        else:
+            potential_power.append(df["predicted_power"][i])
+            deposit_list.append(deposit)
+        i = i + 1
+
+    potential_emissions = potential_power * df['moer'] / 1000
+
+    return potential_power, potential_emissions, deposit_list, activation
+
+
+def random_frame(seed, n=None):
+    # MOER and predicted power with missing values and zero power
+    rng = np.random.default_rng(seed)
+    n = int(rng.integers(1, 500)) if n is None else n
+    moer = rng.uniform(200, 1000, n).round(int(rng.integers(0, 3)))
+    power = rng.uniform(0, 300, n)
+    moer[rng.random(n) < 0.05] = np.nan
+    power[rng.random(n) < 0.05] = np.nan
+    power[rng.random(n) < 0.1] = 0.0
+    index = pd.RangeIndex(n) + int(rng.integers(0, 100))
+    return pd.DataFrame({'moer': moer, 'predicted_power': power}, index=index), rng
+
+
+@pytest.mark.parametrize('seed', range(100))
+def test_shift_matches_row_loop(seed):
+    df, rng = random_frame(seed)
+    threshold = float(np.nanquantile(df['moer'], rng.uniform(0, 1))) if df['moer'].notna().any() else 500.0
+
+    expected = shift_reference(threshold, df)
+    result = shift(threshold, df)
+
+    np.testing.assert_array_equal(result[0], expected[0])
+    np.testing.assert_array_equal(result[1].to_numpy(), expected[1].to_numpy())
+    np.testing.assert_array_equal(result[2], expected[2])
+    assert result[3] == expected[3]
+
+
+@pytest.mark.parametrize('seed', range(100, 150))
+def test_shift_array_matches_row_loop(seed):
+    df, rng = random_frame(seed)
+    threshold = float(rng.uniform(200, 1000))
+
+    expected = shift_reference(threshold, df)
+    potential_power, potential_emissions, deposit, activation = shift_array(
+        threshold, df['moer'].to_numpy(), df['predicted_power'].to_numpy())
+
+    np.testing.assert_array_equal(potential_power, expected[0])
+    np.testing.assert_array_equal(potential_emissions, expected[1].to_numpy())
+    np.testing.assert_array_equal(deposit, expected[2])
+    assert activation == expected[3]
+
+
+
+
+@pytest.mark.parametrize('seed', range(250, 280))
+def test_shift_sweep_matches_row_loop(seed):
+    df, rng = random_frame(seed)
+    thresholds = np.sort(rng.uniform(150, 1050, int(rng.integers(1, 8))))
+    moer, power = df['moer'].to_numpy(), df['predicted_power'].to_numpy()
+
+    sweep = shift_sweep(thresholds, moer, power)
+
+    for i, threshold in enumerate(thresholds):
+        expected = shift_reference(threshold, df)
+        np.testing.assert_array_equal(sweep['potential_power'][i], expected[0])
+        np.testing.assert_array_equal(sweep['potential_emissions'][i], expected[1].to_numpy())
+        np.testing.assert_allclose(sweep['total_emissions'][i], np.nansum(expected[1]), rtol=1e-12)
+        assert sweep['activation'][i] == expected[3]
+    assert sweep['best_threshold'] == thresholds[np.argmin(sweep['total_emissions'])]
+
+
+@pytest.mark.parametrize('seed', range(280, 310))
+def test_shift_batch_matches_row_loop(seed):
+    df, rng = random_frame(seed)
+    assets = int(rng.integers(1, 6))
+    moer = df['moer'].to_numpy()
+    power = rng.uniform(0, 300, (assets, len(df)))
+    power[rng.random(power.shape) < 0.05] = np.nan
+    power[rng.random(power.shape) < 0.1] = 0.0
+    # one threshold per asset, or one for the whole portfolio
+    threshold = rng.uniform(200, 1000, assets) if seed % 2 else float(rng.uniform(200, 1000))
+
+    batch = shift_batch(threshold, moer, power)
+
+    for a in range(assets):
+        asset = pd.DataFrame({'moer': moer, 'predicted_power': power[a]}, index=df.index)
+        expected = shift_reference(np.broadcast_to(threshold, assets)[a], asset)
+        np.testing.assert_array_equal(batch['potential_power'][a], expected[0])
+        np.testing.assert_array_equal(batch['potential_emissions'][a], expected[1].to_numpy())
+        np.testing.assert_array_equal(batch['deposit'][a], expected[2])
+        assert batch['activation'][a] == expected[3]
+
+
+@pytest.mark.parametrize('seed', range(310, 350))
+def test_rolling_threshold_matches_pandas(seed):
+    df, rng = random_frame(seed)
+    moer = df['moer'].to_numpy()
+    window = int(rng.integers(1, 120))
+    quantile = float(rng.choice([0.0, 1.0, rng.uniform(0, 1)]))
+    min_periods = int(rng.integers(1, window + 1))
+
+    result = rolling_threshold(moer, window, quantile, min_periods)
+
+    expected = pd.Series(moer).rolling(window, min_periods=min_periods).quantile(quantile).to_numpy()
+    np.testing.assert_array_equal(np.isnan(result), np.isnan(expected))
+    np.testing.assert_allclose(result, expected, rtol=1e-12)
+
+
+def test_shift_rolling_uses_rolling_threshold():
+    df, _ = random_frame(7, n=2000)
+    moer, power = df['moer'].to_numpy(), df['predicted_power'].to_numpy()
+
+    result = shift_rolling(moer, power, window=96, quantile=0.3)
+
+    expected = shift_array(rolling_threshold(moer, 96, 0.3), moer, power)
+    np.testing.assert_array_equal(result[0], expected[0])
+    np.testing.assert_array_equal(result[2], expected[2])
+
+def run_controller(controller, moer, power):
+    powers, emissions = [], []
+    for m, p in zip(moer.tolist(), power.tolist()):
+        commanded, running = controller.step(m, p)
+        powers.append(commanded)
+        emissions.append(running)
+    return powers, emissions
+
+
+@pytest.mark.parametrize('seed', range(150, 200))
+def test_controller_matches_row_loop(seed):
+    df, rng = random_frame(seed)
+    threshold = float(rng.uniform(200, 1000))
+    moer, power = df['moer'].to_numpy(), df['predicted_power'].to_numpy()
+
+    expected = shift_reference(threshold, df)
+    controller = ShiftController(threshold)
+    powers, emissions = run_controller(controller, moer, power)
+
+    running, expected_running = 0.0, []
+    for e in expected[1].tolist():
+        if not np.isnan(e):
+            running = running + e
+        expected_running.append(running)
+
+    np.testing.assert_array_equal(powers, expected[0])
+    np.testing.assert_array_equal(emissions, expected_running)
+    np.testing.assert_equal(controller.deposit, expected[2][-1])
+    assert controller.activation == expected[3]
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_controller_resumes_from_state(seed):
+    df, rng = random_frame(seed, n=300)
+    threshold = float(rng.uniform(200, 1000))
+    moer, power = df['moer'].to_numpy(), df['predicted_power'].to_numpy()
+    cut = int(rng.integers(0, 300))
+
+    whole = ShiftController(threshold)
+    expected = run_controller(whole, moer, power)
+
+    first = ShiftController(threshold)
+    head = run_controller(first, moer[:cut], power[:cut])
+    resumed = ShiftController.from_state(json.loads(json.dumps(first.state())))
+    tail = run_controller(resumed, moer[cut:], power[cut:])
+
+    np.testing.assert_array_equal(head[0] + tail[0], expected[0])
+    np.testing.assert_array_equal(head[1] + tail[1], expected[1])
+    np.testing.assert_equal(resumed.state(), whole.state())
+
+def hvac_load(times):
+    # Base load plus a daytime cooling hump
+    hour = (times.dt.hour + times.dt.minute / 60).to_numpy()
+    return 100 + 150 * np.clip(np.sin(np.pi * (hour - 6) / 14), 0, None)
+
+
+@pytest.mark.parametrize('weeks', [1, 4])
+def test_shift_optimal_beats_best_threshold(weeks):
+    moer_df = pd.read_csv(MOER_FILE).iloc[:weeks * 7 * 96]
+    moer = moer_df['moer'].to_numpy()
+    times = pd.to_datetime(moer_df['datetime'], utc=True).dt.tz_convert('America/Los_Angeles')
+    power = hvac_load(times)
+
+    sweep = shift_sweep(np.linspace(np.nanmin(moer), np.nanmax(moer), 200), moer, power)
+    _, potential_emissions, deposit, _ = shift_optimal(moer, power)
+
+    assert np.nansum(potential_emissions) <= sweep['total_emissions'].min()
+    assert (deposit <= 1e-9 * power.sum()).all()
+
+
+def test_shift_optimal_year_under_a_second():
+    moer_df = pd.read_csv(MOER_FILE)
+    moer = moer_df['moer'].to_numpy()
+    times = pd.to_datetime(moer_df['datetime'], utc=True).dt.tz_convert('America/Los_Angeles')
+    power = hvac_load(times)
+
+    start = time.perf_counter()
+    _, potential_emissions, _, _ = shift_optimal(moer, power)
+    elapsed = time.perf_counter() - start
+
+    sweep = shift_sweep(np.linspace(np.nanmin(moer), np.nanmax(moer), 50), moer, power)
+    assert len(moer) >= 365 * 96
+    assert elapsed < 1.0
+    assert np.nansum(potential_emissions) <= sweep['total_emissions'].min()
+
+
+@pytest.mark.parametrize('seed', range(200, 250))
+def test_shift_optimal_never_worse_than_shift(seed):
+    df, rng = random_frame(seed)
+    moer, power = df['moer'].to_numpy(), df['predicted_power'].to_numpy()
+    threshold = float(rng.uniform(200, 1000))
+
+    potential_power, _, deposit, _ = shift_optimal(moer, power)
+    heuristic = shift_array(threshold, moer, power)[0]
+
+    # compared on the intervals shift_optimal() may move
+    valid = ~np.isnan(moer) & ~np.isnan(power)
+    assert (potential_power[valid] * moer[valid]).sum() <= (heuristic[valid] * moer[valid]).sum() + 1e-6
+    assert (deposit <= 1e-9 * np.nansum(power) + 1e-12).all()
+    assert (potential_power[valid] >= 0.7 * power[valid] - 1e-9).all()
+    assert (potential_power[valid] <= 1.5 * power[valid] + 1e-9).all()
+
+
+def test_shift_optimal_without_flexibility():
+    moer = np.array([300.0, 500.0, np.nan, 400.0])
+    power = np.zeros(4)
+    potential_power, _, deposit, activation = shift_optimal(moer, power)
+
+    np.testing.assert_array_equal(potential_power, power)
+    np.testing.assert_array_equal(deposit, 0.0)
+    assert activation == 0